@@ -1,19 +1,23 @@
 from ssl import SSLError
+import re
 from time import sleep
 import logging
 
-from requests import get
 from requests.exceptions import ConnectionError as RequestsConnectionError, ReadTimeout, ChunkedEncodingError
 from urllib3.exceptions import SSLError as u3SSLError
 
-from deemix.utils.crypto import _md5, _ecbCrypt, _ecbDecrypt, generateBlowfishKey, decryptChunk
+from deemix.utils.crypto import _md5, _ecbCrypt, _ecbDecrypt, generateBlowfishKey, StripeDecryptor, STRIPE_SIZE
 
-from deemix.utils import USER_AGENT_HEADER
+from deemix.utils.session import sessionPool
 from deemix.types.DownloadObjects import Single
-from deemix.errors import DownloadCanceled, DownloadEmpty
+from deemix.errors import DownloadCanceled, DownloadEmpty, DownloadResumeFailed
 
 logger = logging.getLogger('deemix')
 
+# Read the stream in blocks of whole stripes
+STREAM_READ_SIZE = STRIPE_SIZE * 32
+MAX_STREAM_RETRIES = 5
+
 def generateStreamPath(sng_id, md5, media_version, media_format):
     urlPart = b'\xa4'.join(
         [md5.encode(), str(media_format).encode(), str(sng_id).encode(), str(media_version).encode()])
@@ -40,11 +44,17 @@ def reverseStreamURL(url):
     urlPart = url[url.find("/1/")+3:]
     return reverseStreamPath(urlPart)
 
+def parseContentRange(contentRange):
+    # "bytes 6144-40000/40001" => (6144, 40001)
+    (rangeStart, total) = re.match(r"bytes (\d+)-\d+/(\d+)", contentRange).groups()
+    return (int(rangeStart), int(total))
+
 def streamTrack(outputStream, track, start=0, downloadObject=None, listener=None):
+    # start must be at a stripe boundary of the track stream
     if downloadObject and downloadObject.isCanceled: raise DownloadCanceled
-    headers= {'User-Agent': USER_AGENT_HEADER}
-    chunkLength = start
     isCryptedStream = "/mobile/" in track.downloadURL or "/media/" in track.downloadURL
+    if isCryptedStream:
+        decryptor = StripeDecryptor(generateBlowfishKey(str(track.id)))
 
     itemData = {
         'id': track.id,
@@ -52,60 +62,88 @@ def streamTrack(outputStream, track, start=0, downloadObject=None, listener=None
         'artist': track.mainArtist.name
     }
 
-    try:
-        with get(track.downloadURL, headers=headers, stream=True, timeout=10) as request:
-            request.raise_for_status()
-            if isCryptedStream:
-                blowfish_key = generateBlowfishKey(str(track.id))
-
-            complete = int(request.headers["Content-Length"])
-            if complete == 0: raise DownloadEmpty
-            if start != 0:
-                responseRange = request.headers["Content-Range"]
-                if listener:
-                    listener.send('downloadInfo', {
-                        'uuid': downloadObject.uuid,
-                        'data': itemData,
-                        'state': "downloading",
-                        'alreadyStarted': True,
-                        'value': responseRange
-                    })
+    buffer = bytearray(STREAM_READ_SIZE)
+    view = memoryview(buffer)
+    # Position in the track stream of the next byte to write, always at a stripe boundary
+    position = start
+    total = 0
+    retries = 0
+    lastDropPosition = start
+
+    def writeBuffer(data):
+        nonlocal position
+        streamLength = len(data)
+        if isCryptedStream: decryptor.decrypt(data)
+
+        if position == 0 and data[0] == 0 and bytes(data[4:8]) != b"ftyp":
+            for i, byte in enumerate(data):
+                if byte != 0: break
+            data = data[i:]
+
+        outputStream.write(data)
+        position += streamLength
+
+        if downloadObject:
+            if isinstance(downloadObject, Single):
+                chunkProgres = (position / total) * 100
+                downloadObject.progressNext = chunkProgres
             else:
+                chunkProgres = (streamLength / total) / downloadObject.size * 100
+                downloadObject.progressNext += chunkProgres
+            downloadObject.updateProgress(listener)
+
+    while True:
+        headers = {}
+        if position != 0: headers['Range'] = f"bytes={position}-"
+
+        try:
+            with sessionPool.get(track.downloadURL, headers=headers, stream=True, timeout=10) as request:
+                request.raise_for_status()
+
+                # Bytes to drop if the server doesn't start the response at the requested position
+                skip = position
+                if request.status_code == 206:
+                    (rangeStart, total) = parseContentRange(request.headers["Content-Range"])
+                    if rangeStart > position: raise DownloadResumeFailed
+                    skip = position - rangeStart
+                else:
+                    total = int(request.headers["Content-Length"])
+                if total == 0: raise DownloadEmpty
+
                 if listener:
                     listener.send('downloadInfo', {
                         'uuid': downloadObject.uuid,
                         'data': itemData,
                         'state': "downloading",
-                        'alreadyStarted': False,
-                        'value': complete
+                        'alreadyStarted': position != 0,
+                        'value': request.headers.get("Content-Range") if position != 0 else total
                     })
 
-            isStart = True
-            for chunk in request.iter_content(2048 * 3):
-                if isCryptedStream:
-                    if len(chunk) >= 2048:
-                        chunk = decryptChunk(blowfish_key, chunk[0:2048]) + chunk[2048:]
-
-                if isStart and chunk[0] == 0 and chunk[4:8].decode('utf-8') != "ftyp":
-                    for i, byte in enumerate(chunk):
-                        if byte != 0: break
-                    chunk = chunk[i:]
-                isStart = False
-
-                outputStream.write(chunk)
-                chunkLength += len(chunk)
-
-                if downloadObject:
-                    if isinstance(downloadObject, Single):
-                        chunkProgres = (chunkLength / (complete + start)) * 100
-                        downloadObject.progressNext = chunkProgres
-                    else:
-                        chunkProgres = (len(chunk) / (complete + start)) / downloadObject.size * 100
-                        downloadObject.progressNext += chunkProgres
-                    downloadObject.updateProgress(listener)
-
-    except (SSLError, u3SSLError):
-        streamTrack(outputStream, track, chunkLength, downloadObject, listener)
-    except (RequestsConnectionError, ReadTimeout, ChunkedEncodingError):
-        sleep(2)
-        streamTrack(outputStream, track, start, downloadObject, listener)
+                # Collect chunks into the buffer, so that it is decrypted and written in whole stripes
+                filled = 0
+                for chunk in request.iter_content(STREAM_READ_SIZE):
+                    chunk = memoryview(chunk)
+                    if skip:
+                        skipped = min(skip, len(chunk))
+                        chunk = chunk[skipped:]
+                        skip -= skipped
+                    while chunk:
+                        size = min(len(chunk), STREAM_READ_SIZE - filled)
+                        view[filled:filled + size] = chunk[:size]
+                        filled += size
+                        chunk = chunk[size:]
+                        if filled == STREAM_READ_SIZE:
+                            writeBuffer(view)
+                            filled = 0
+                if filled: writeBuffer(view[:filled])
+            return
+
+        except (SSLError, u3SSLError, RequestsConnectionError, ReadTimeout, ChunkedEncodingError) as e:
+            # Resume from the last written stripe, the partially filled buffer is requested again
+            # Only drops in a row count towards the limit
+            if position > lastDropPosition: retries = 0
+            lastDropPosition = position
+            retries += 1
+            if retries > MAX_STREAM_RETRIES: raise
+            logger.warning("%s Connection lost at byte %d, resuming: %s", f"[{itemData['artist']} - {itemData['title']}]", position, e)
+            sleep(2 ** retries)
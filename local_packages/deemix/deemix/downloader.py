@@ -1,35 +1,36 @@
-from concurrent.futures import ThreadPoolExecutor
-from time import sleep
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import BoundedSemaphore, Lock, get_ident
+from time import sleep, time
 import traceback
 
 from os.path import sep as pathSep
-from os import makedirs, system as execute
+from os import makedirs, replace, system as execute
 from pathlib import Path
 from shlex import quote
 import errno
 
 import logging
-from tempfile import gettempdir
 
 import requests
-from requests import get
 
 from urllib3.exceptions import SSLError as u3SSLError
 
 from mutagen.flac import FLACNoHeaderError, error as FLACError
 
 from deezer import TrackFormats
-from deezer.errors import WrongLicense, WrongGeolocation
+from deezer.errors import DeezerError, WrongLicense, WrongGeolocation
 from deezer.utils import map_track
 from deemix.types.DownloadObjects import Single, Collection
 from deemix.types.Track import Track
 from deemix.types.Picture import StaticPicture
-from deemix.utils import USER_AGENT_HEADER
+from deemix.utils.cache import artworkCache
+from deemix.utils.crypto import _md5
+from deemix.utils.session import sessionPool
 from deemix.utils.pathtemplates import generatePath, generateAlbumName, generateArtistName, generateDownloadObjectName
-from deemix.tagger import tagID3, tagFLAC
+from deemix.tagger import tagID3, tagFLAC, ID3TagStream, FLACTagStream
 from deemix.decryption import generateCryptedStreamURL, streamTrack
 from deemix.settings import OverwriteOption
-from deemix.errors import DownloadFailed, MD5NotFound, DownloadCanceled, PreferredBitrateNotFound, TrackNot360, AlbumDoesntExists, DownloadError, ErrorMessages
+from deemix.errors import DownloadFailed, DownloadResumeFailed, MD5NotFound, DownloadCanceled, PreferredBitrateNotFound, TrackNot360, AlbumDoesntExists, DownloadError, ErrorMessages
 
 logger = logging.getLogger('deemix')
 
@@ -55,37 +56,138 @@ formatsName = {
     TrackFormats.MP4_RA1: 'MP4_RA1'
 }
 
-TEMPDIR = Path(gettempdir()) / 'deemix-imgs'
+TEMPDIR = artworkCache.folder
 if not TEMPDIR.is_dir(): makedirs(TEMPDIR)
 
+# Image downloads in progress, by URL and destination
+imageFetches = {}
+imageFetchesLock = Lock()
+
 def downloadImage(url, path, overwrite=OverwriteOption.DONT_OVERWRITE):
     if path.is_file() and overwrite not in [OverwriteOption.OVERWRITE, OverwriteOption.ONLY_TAGS, OverwriteOption.KEEP_BOTH]: return path
 
+    # Only one thread downloads an image, the others wait for its result
+    key = (url, str(path))
+    with imageFetchesLock:
+        fetch = imageFetches.get(key)
+        isOwner = fetch is None
+        if isOwner: fetch = imageFetches[key] = Future()
+    if not isOwner: return fetch.result()
+
+    try:
+        result = fetchImage(url, path)
+        fetch.set_result(result)
+        return result
+    except BaseException as e:
+        fetch.set_exception(e)
+        raise
+    finally:
+        with imageFetchesLock:
+            del imageFetches[key]
+
+def fetchImage(url, path):
+    # Write to a temporary file first, readers never see a partial image
+    tempPath = path.with_name(f"{path.name}.{get_ident()}.tmp")
     try:
-        image = get(url, headers={'User-Agent': USER_AGENT_HEADER}, timeout=30)
+        image = sessionPool.get(url, timeout=30)
         image.raise_for_status()
-        with open(path, 'wb') as f:
+        with open(tempPath, 'wb') as f:
             f.write(image.content)
+        replace(tempPath, path)
         return path
     except requests.exceptions.HTTPError:
-        if path.is_file(): path.unlink()
         if 'cdns-images.dzcdn.net' in url:
             urlBase = url[:url.rfind("/")+1]
             pictureUrl = url[len(urlBase):]
             pictureSize = int(pictureUrl[:pictureUrl.find("x")])
             if pictureSize > 1200:
-                return downloadImage(urlBase+pictureUrl.replace(f"{pictureSize}x{pictureSize}", '1200x1200'), path, overwrite)
+                return fetchImage(urlBase+pictureUrl.replace(f"{pictureSize}x{pictureSize}", '1200x1200'), path)
     except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError, u3SSLError):
-        if path.is_file(): path.unlink()
+        if tempPath.is_file(): tempPath.unlink()
         sleep(5)
-        return downloadImage(url, path, overwrite)
+        return fetchImage(url, path)
     except OSError as e:
-        if path.is_file(): path.unlink()
+        if tempPath.is_file(): tempPath.unlink()
         if e.errno == errno.ENOSPC: raise DownloadFailed("noSpaceLeft") from e
         logger.exception("Error while downloading an image, you should report this to the developers: %s", e)
     return None
 
-def getPreferredBitrate(dz, track, preferredBitrate, shouldFallback, feelingLucky, uuid=None, listener=None):
+class TrackURLResolver:
+    """Resolves the media URLs of many tracks with a single request per batch
+    trackTokens maps track ids to the (token, expiration) they were hydrated with, only the other tracks are fetched"""
+    def __init__(self, dz, trackIds, bitrate, batchSize=50, maxAge=600, trackTokens=None):
+        self.dz = dz
+        self.trackIds = [str(trackId) for trackId in trackIds]
+        self.trackTokens = {str(trackId): token for (trackId, token) in (trackTokens or {}).items()}
+        self.formatName = formatsName.get(int(bitrate))
+        self.batchSize = batchSize
+        self.maxAge = maxAge # Media URLs expire, resolve them again after maxAge seconds
+        self.urls = {}
+        self.lock = Lock()
+
+    def isResolved(self, trackId, now):
+        return trackId in self.urls and now - self.urls[trackId][1] < self.maxAge
+
+    def get(self, trackId, formatName):
+        if formatName != self.formatName: return None
+        trackId = str(trackId)
+        with self.lock:
+            if not self.isResolved(trackId, time()): self.resolveBatch(trackId)
+            return self.urls[trackId][0]
+
+    def resolveBatch(self, trackId):
+        # Resolve the requested track together with the next unresolved tracks
+        now = time()
+        batch = [trackId] + [i for i in self.trackIds if i != trackId and not self.isResolved(i, now)]
+        batch = [i for i in batch if int(i) > 0][:self.batchSize]
+
+        urls = {}
+        if batch:
+            try:
+                # Tokens that expire soon are fetched again
+                tokens = {i: self.trackTokens[i][0] for i in batch if i in self.trackTokens and self.trackTokens[i][1] > now + 60}
+                unknown = [i for i in batch if i not in tokens]
+                if unknown:
+                    # Results are matched by id, song.getListData leaves out the tracks it can't find
+                    tracksData = self.dz.gw.get_tracks(unknown)
+                    for trackData in tracksData:
+                        if not trackData.get('TRACK_TOKEN') or str(trackData['SNG_ID']) not in unknown: continue
+                        tokens[str(trackData['SNG_ID'])] = trackData['TRACK_TOKEN']
+                        self.trackTokens[str(trackData['SNG_ID'])] = (trackData['TRACK_TOKEN'], int(trackData.get('TRACK_TOKEN_EXPIRE', 0)))
+                tokens = {i: tokens[i] for i in batch if i in tokens}
+                if tokens: urls = dict(zip(tokens, self.getMediaURLs(list(tokens.values()))))
+            except (DeezerError, requests.exceptions.RequestException, IndexError) as e:
+                logger.debug("Couldn't resolve %d track URLs at once: %s", len(batch), e)
+
+        # Tracks without URL are resolved one by one by getPreferredBitrate
+        self.urls[trackId] = (None, now)
+        for i in batch:
+            self.urls[i] = (urls.get(i), now)
+
+    def getMediaURLs(self, tokens):
+        # Same request as dz.get_tracks_url, which adds extra entries for errors, here each token gets exactly one result
+        user = self.dz.current_user
+        if not user.get('license_token'): return [None] * len(tokens)
+        if self.formatName == "FLAC" and not user.get('can_stream_lossless') or self.formatName == "MP3_320" and not user.get('can_stream_hq'):
+            return [None] * len(tokens)
+        request = self.dz.session.post(
+            "https://media.deezer.com/v1/get_url",
+            json={
+                'license_token': user['license_token'],
+                'media': [{
+                    'type': "FULL",
+                    'formats': [{ 'cipher': "BF_CBC_STRIPE", 'format': self.formatName }]
+                }],
+                'track_tokens': tokens
+            },
+            headers=self.dz.http_headers
+        )
+        request.raise_for_status()
+        results = request.json().get('data', [])
+        if len(results) != len(tokens): return [None] * len(tokens)
+        return [result['media'][0]['sources'][0]['url'] if result.get('media') else None for result in results]
+
+def getPreferredBitrate(dz, track, preferredBitrate, shouldFallback, feelingLucky, uuid=None, listener=None, urlResolver=None):
     preferredBitrate = int(preferredBitrate)
 
     falledBack = False
@@ -95,11 +197,7 @@ def getPreferredBitrate(dz, track, preferredBitrate, shouldFallback, feelingLuck
 
     def testURL(track, url, formatName):
         if not url: return False
-        request = requests.head(
-            url,
-            headers={'User-Agent': USER_AGENT_HEADER},
-            timeout=30
-        )
+        request = sessionPool.head(url, timeout=30)
         try:
             request.raise_for_status()
             track.filesizes[f"{formatName.lower()}"] = int(request.headers["Content-Length"])
@@ -118,7 +216,8 @@ def getPreferredBitrate(dz, track, preferredBitrate, shouldFallback, feelingLuck
         )
         if track.filesizes.get(formatName.lower()) and track.filesizes[formatName.lower()] != "0":
             try:
-                url = dz.get_track_url(track.trackToken, formatName)
+                if urlResolver: url = urlResolver.get(track.id, formatName)
+                if not url: url = dz.get_track_url(track.trackToken, formatName)
             except (WrongLicense, WrongGeolocation) as e:
                 wrongLicense = isinstance(e, WrongLicense)
                 isGeolocked = isinstance(e, WrongGeolocation)
@@ -201,12 +300,13 @@ def getPreferredBitrate(dz, track, preferredBitrate, shouldFallback, feelingLuck
     return TrackFormats.DEFAULT
 
 class Downloader:
-    def __init__(self, dz, downloadObject, settings, listener=None):
+    def __init__(self, dz, downloadObject, settings, listener=None, urlResolver=None):
         self.dz = dz
         self.downloadObject = downloadObject
         self.settings = settings
         self.bitrate = downloadObject.bitrate
         self.listener = listener
+        self.urlResolver = urlResolver
 
         self.playlistCoverName = None
         self.playlistURLs = []
@@ -220,14 +320,24 @@ class Downloader:
                 })
                 if track: self.afterDownloadSingle(track)
             elif isinstance(self.downloadObject, Collection):
+                if not self.urlResolver:
+                    trackIds = [track['id'] for track in self.downloadObject.collection['tracks']]
+                    self.urlResolver = TrackURLResolver(self.dz, trackIds, self.bitrate)
                 tracks = [None] * len(self.downloadObject.collection['tracks'])
-                with ThreadPoolExecutor(self.settings['queueConcurrency']) as executor:
+                # Metadata is fetched ahead in its own pool, so transfers don't wait on API calls
+                # Only a few tracks per transfer slot are fetched ahead, each finished transfer lets another one in
+                lookahead = BoundedSemaphore(self.settings['queueConcurrency'] * 4)
+                with ThreadPoolExecutor(self.settings['metadataConcurrency']) as metadataExecutor, \
+                        ThreadPoolExecutor(self.settings['queueConcurrency']) as executor:
                     for pos, track in enumerate(self.downloadObject.collection['tracks'], start=0):
-                        tracks[pos] = executor.submit(self.downloadWrapper, {
+                        extraData = {
                             'trackAPI': track,
                             'albumAPI': self.downloadObject.collection.get('albumAPI'),
                             'playlistAPI': self.downloadObject.collection.get('playlistAPI')
-                        })
+                        }
+                        lookahead.acquire()
+                        prefetchedTrack = metadataExecutor.submit(self.prefetchTrack, extraData)
+                        tracks[pos] = executor.submit(self.downloadPrefetched, extraData, prefetchedTrack, lookahead)
                 self.afterDownloadCollection(tracks)
 
         if self.listener:
@@ -245,6 +355,41 @@ class Downloader:
         if self.listener:
             self.listener.send('downloadWarn', {'uuid': self.downloadObject.uuid, 'data': data, 'state': state, 'solution': solution})
 
+    def prefetchTrack(self, extraData):
+        trackAPI = extraData['trackAPI']
+        if self.downloadObject.isCanceled or int(trackAPI['id']) == 0: return None
+
+        itemData = {
+            'id': trackAPI['id'],
+            'title': trackAPI['title'],
+            'artist': trackAPI['artist']['name']
+        }
+
+        self.log(itemData, "getTags")
+        try:
+            track = Track().parseData(
+                dz=self.dz,
+                track_id=trackAPI['id'],
+                trackAPI=trackAPI,
+                albumAPI=extraData.get('albumAPI'),
+                playlistAPI=extraData.get('playlistAPI')
+            )
+        except Exception:
+            # Parsed again by download, which reports the error
+            return None
+        self.log(itemData, "gotTags")
+
+        # Warm up the batch of URLs this track belongs to
+        if self.urlResolver and track.MD5 != '':
+            self.urlResolver.get(track.id, self.urlResolver.formatName)
+        return track
+
+    def downloadPrefetched(self, extraData, prefetchedTrack, lookahead):
+        try:
+            return self.downloadWrapper(extraData, prefetchedTrack.result())
+        finally:
+            lookahead.release()
+
     def download(self, extraData, track=None):
         returnData = {}
         trackAPI = extraData.get('trackAPI')
@@ -294,7 +439,7 @@ class Downloader:
                 track,
                 self.bitrate,
                 self.settings['fallbackBitrate'], self.settings['feelingLucky'],
-                self.downloadObject.uuid, self.listener
+                self.downloadObject.uuid, self.listener, self.urlResolver
             )
         except WrongLicense as e:
             raise DownloadFailed("wrongLicense") from e
@@ -329,11 +474,13 @@ class Downloader:
         track.album.embeddedCoverURL = track.album.pic.getURL(self.settings['embeddedArtworkSize'], embeddedImageFormat)
         ext = track.album.embeddedCoverURL[-4:]
         if ext[0] != ".": ext = ".jpg" # Check for Spotify images
-        track.album.embeddedCoverPath = TEMPDIR / ((f"pl{track.playlist.id}" if track.album.isPlaylist else f"alb{track.album.id}") + f"_{self.settings['embeddedArtworkSize']}{ext}")
+        # Covers are shared by every album or playlist with the same picture, static pictures are keyed by their URL
+        coverKey = getattr(track.album.pic, "md5", "") or _md5(track.album.embeddedCoverURL)
+        coverName = f"{coverKey}_{self.settings['embeddedArtworkSize']}_{embeddedImageFormat}{ext}"
 
         # Download and cache coverart
         self.log(itemData, "getAlbumArt")
-        track.album.embeddedCoverPath = downloadImage(track.album.embeddedCoverURL, track.album.embeddedCoverPath)
+        track.album.embeddedCoverPath = artworkCache.fetch(coverName, lambda path: downloadImage(track.album.embeddedCoverURL, path))
         self.log(itemData, "gotAlbumArt")
 
         # Save local album art
@@ -387,6 +534,7 @@ class Downloader:
 
         # Check for overwrite settings
         trackAlreadyDownloaded = writepath.is_file()
+        tagsWritten = False
 
         # Don't overwrite and don't mind extension
         if not trackAlreadyDownloaded and self.settings['overwriteFile'] == OverwriteOption.DONT_CHECK_EXT:
@@ -409,9 +557,22 @@ class Downloader:
         if not trackAlreadyDownloaded or self.settings['overwriteFile'] == OverwriteOption.OVERWRITE:
             track.downloadURL = track.urls[formatsName[track.bitrate]]
             if not track.downloadURL: raise DownloadFailed('notAvailable', track)
+            # Write the tags ahead of the audio, so the file isn't rewritten when tagging
+            tagsWritten = self.settings['streamTags'] and extension in ['.mp3', '.flac'] and not track.local
             try:
                 with open(writepath, 'wb') as stream:
-                    streamTrack(stream, track, downloadObject=self.downloadObject, listener=self.listener)
+                    if tagsWritten:
+                        tagStream = (ID3TagStream if extension == '.mp3' else FLACTagStream)(stream, track, self.settings['tags'])
+                        streamTrack(tagStream, track, downloadObject=self.downloadObject, listener=self.listener)
+                        tagStream.close()
+                    else:
+                        streamTrack(stream, track, downloadObject=self.downloadObject, listener=self.listener)
+            except (FLACNoHeaderError, FLACError):
+                return self.fallbackFromFLAC(extraData, track, writepath, itemData)
+            except DownloadResumeFailed as e:
+                # Part of the track is already written, don't leave a truncated file behind
+                if writepath.is_file(): writepath.unlink()
+                raise DownloadFailed('resumeFailed') from e
             except requests.exceptions.HTTPError as e:
                 if writepath.is_file(): writepath.unlink()
                 raise DownloadFailed('notAvailable', track) from e
@@ -425,7 +586,7 @@ class Downloader:
             self.downloadObject.completeTrackProgress(self.listener)
 
         # Adding tags
-        if (not trackAlreadyDownloaded or self.settings['overwriteFile'] in [OverwriteOption.ONLY_TAGS, OverwriteOption.OVERWRITE]) and not track.local:
+        if (not trackAlreadyDownloaded or self.settings['overwriteFile'] in [OverwriteOption.ONLY_TAGS, OverwriteOption.OVERWRITE]) and not track.local and not tagsWritten:
             self.log(itemData, "tagging")
             if extension == '.mp3':
                 tagID3(writepath, track, self.settings['tags'])
@@ -433,12 +594,7 @@ class Downloader:
                 try:
                     tagFLAC(writepath, track, self.settings['tags'])
                 except (FLACNoHeaderError, FLACError):
-                    writepath.unlink()
-                    logger.warning("%s Track not available in FLAC, falling back if necessary", f"{itemData['artist']} - {itemData['title']}")
-                    self.downloadObject.removeTrackProgress(self.listener)
-                    track.filesizes['FILESIZE_FLAC'] = "0"
-                    track.filesizes['FILESIZE_FLAC_TESTED'] = True
-                    return self.download(extraData, track=track)
+                    return self.fallbackFromFLAC(extraData, track, writepath, itemData)
             self.log(itemData, "tagged")
 
         if track.searched: returnData['searched'] = True
@@ -455,6 +611,14 @@ class Downloader:
         self.downloadObject.files.append(returnData)
         return returnData
 
+    def fallbackFromFLAC(self, extraData, track, writepath, itemData):
+        if writepath.is_file(): writepath.unlink()
+        logger.warning("%s Track not available in FLAC, falling back if necessary", f"{itemData['artist']} - {itemData['title']}")
+        self.downloadObject.removeTrackProgress(self.listener)
+        track.filesizes['FILESIZE_FLAC'] = "0"
+        track.filesizes['FILESIZE_FLAC_TESTED'] = True
+        return self.download(extraData, track=track)
+
     def downloadWrapper(self, extraData, track=None):
         trackAPI = extraData['trackAPI']
         # Temp metadata to generate logs
@@ -475,6 +639,7 @@ class Downloader:
                     newTrack = map_track(newTrack)
                     track.parseEssentialData(newTrack)
                     return self.downloadWrapper(extraData, track)
+                if self.settings['fallbackISRC']: track.loadAlbumsFallback(self.dz)
                 if len(track.albumsFallback) != 0 and self.settings['fallbackISRC']:
                     newAlbumID = track.albumsFallback.pop()
                     newAlbum = self.dz.gw.get_album_page(newAlbumID)
@@ -58,6 +58,7 @@ ErrorMessages = {
     'notAvailable': "Track not available on deezer's servers!",
     'notAvailableNoAlternative': "Track not available on deezer's servers and no alternative found!",
     'noSpaceLeft': "No space left on target drive, clean up some space for the tracks",
+    'resumeFailed': "Track download was interrupted and couldn't be resumed.",
     'albumDoesntExists': "Track's album does not exsist, failed to gather info.",
     'notLoggedIn': "You need to login to download tracks.",
     'wrongGeolocation': "Your account can't stream the track from your current country.",
@@ -83,6 +84,9 @@ class DownloadCanceled(DownloadError):
 class DownloadEmpty(DownloadError):
     pass
 
+class DownloadResumeFailed(DownloadError):
+    pass
+
 class TrackError(DeemixError):
     """Track generation related errors"""
 
@@ -3,12 +3,17 @@ import logging
 from deezer.errors import GWAPIError, APIError
 from deezer.utils import map_user_playlist, map_track, map_album
 
+from deemix.types import VARIOUS_ARTISTS
 from deemix.types.DownloadObjects import Single, Collection
+from deemix.utils.cache import entityCache
 from deemix.errors import GenerationError, ISRCnotOnDeezer, InvalidID, NotYourPrivatePlaylist
 
 logger = logging.getLogger('deemix')
 
-def generateTrackItem(dz, link_id, bitrate, trackAPI=None, albumAPI=None):
+def getVariousArtist(dz):
+    return entityCache.fetch(VARIOUS_ARTISTS, dz.api.get_artist)
+
+def generateTrackItem(dz, link_id, bitrate, trackAPI=None, albumAPI=None, keepTrackToken=False):
     # Get essential track info
     if not trackAPI:
         if str(link_id).startswith("isrc") or int(link_id) > 0:
@@ -36,7 +41,8 @@ def generateTrackItem(dz, link_id, bitrate, trackAPI=None, albumAPI=None):
     else:
         cover = f"https://e-cdns-images.dzcdn.net/images/cover/{trackAPI['md5_image']}/75x75-000000-80-0-0.jpg"
 
-    if 'track_token' in trackAPI: del trackAPI['track_token']
+    # Track tokens expire, only keep them for items that are downloaded right away
+    if 'track_token' in trackAPI and not keepTrackToken: del trackAPI['track_token']
 
     return Single({
         'type': 'track',
@@ -52,6 +58,33 @@ def generateTrackItem(dz, link_id, bitrate, trackAPI=None, albumAPI=None):
         }
     })
 
+def getTracksAPI(dz, trackIds, batchSize=100):
+    # Get the gw data of many tracks at once, mapped to the API format and keyed by track id
+    # Tracks that can't be fetched are left out
+    tracksAPI = {}
+    trackIds = [str(trackId) for trackId in trackIds if int(trackId) > 0]
+    for i in range(0, len(trackIds), batchSize):
+        batch = trackIds[i:i + batchSize]
+        try:
+            tracksAPI_gw = dz.gw.get_tracks(batch)
+        except (GWAPIError, IndexError) as e:
+            logger.warning("Couldn't get data of %d tracks at once: %s", len(batch), str(e))
+            continue
+
+        for trackAPI_gw in tracksAPI_gw:
+            trackId = str(trackAPI_gw.get('SNG_ID'))
+            if trackId in batch: tracksAPI[trackId] = map_track(trackAPI_gw)
+    return tracksAPI
+
+def generateTrackItems(dz, link_ids, bitrate, batchSize=100):
+    # Track.parseData doesn't need to fetch the track page of the generated tracks one by one
+    # song.getListData has no lyrics and alternative albums: the lyrics are still fetched per track and
+    # the alternative albums only when the ISRC fallback needs them
+    # Tracks that can't be hydrated are left out, generate them with generateTrackItem
+    tracksAPI = getTracksAPI(dz, link_ids, batchSize)
+    return {link_id: generateTrackItem(dz, link_id, bitrate, trackAPI=trackAPI, keepTrackToken=True)
+            for (link_id, trackAPI) in tracksAPI.items()}
+
 def generateAlbumItem(dz, link_id, bitrate, rootArtist=None):
     # Get essential album info
     if str(link_id).startswith('upc'):
@@ -150,7 +183,7 @@ def generatePlaylistItem(dz, link_id, bitrate, playlistAPI=None, playlistTracksA
 
     if not playlistTracksAPI:
         playlistTracksAPI = dz.gw.get_playlist_tracks(link_id)
-    playlistAPI['various_artist'] = dz.api.get_artist(5080) # Useful for save as compilation
+    playlistAPI['various_artist'] = getVariousArtist(dz) # Useful for save as compilation
 
     totalSize = len(playlistTracksAPI)
     playlistAPI['nb_tracks'] = totalSize
@@ -1,13 +1,16 @@
 from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
 import json
 from copy import deepcopy
 from pathlib import Path
 import re
+import sqlite3
 from urllib.request import urlopen
 from deezer.errors import DataException
 from deemix.plugins import Plugin
 from deemix.utils.localpaths import getConfigFolder
-from deemix.itemgen import generateTrackItem, generateAlbumItem
+from deemix.itemgen import generateTrackItem, generateAlbumItem, getVariousArtist
+from deemix.utils.ratelimit import deezerAPIRateLimiter
 from deemix.errors import GenerationError, TrackNotOnDeezer, AlbumNotOnDeezer
 from deemix.types.DownloadObjects import Convertable, Collection
 
@@ -15,6 +18,106 @@ import spotipy
 SpotifyClientCredentials = spotipy.oauth2.SpotifyClientCredentials
 CacheFileHandler = spotipy.cache_handler.CacheFileHandler
 
+# Only the fields used by the conversion are requested
+TRACK_FIELDS = "id,name,explicit,artists(name),album(name),external_ids"
+PLAYLIST_FIELDS = "id,name,description,public,collaborative,snapshot_id,images,external_urls,followers(total),owner(id,display_name,href)," \
+                  f"tracks(href,total,items(track({TRACK_FIELDS})))"
+PLAYLIST_ITEMS_FIELDS = f"items(track({TRACK_FIELDS}))"
+PLAYLIST_PAGE_SIZE = 100
+PLAYLIST_FETCH_WORKERS = 5
+
+class SpotifyCache:
+    """ISRC and UPC of Spotify tracks and albums, stored in SQLite.
+    Writes are batched, they're committed every COMMIT_SIZE writes or on commit()"""
+    COMMIT_SIZE = 500
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = Lock()
+        self.pending = 0
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS tracks (id TEXT PRIMARY KEY, data TEXT NOT NULL)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS albums (id TEXT PRIMARY KEY, data TEXT NOT NULL)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS isrcs (id TEXT PRIMARY KEY, data TEXT NOT NULL)")
+        self.conn.commit()
+
+    def get(self, table, key):
+        with self.lock:
+            row = self.conn.execute(f"SELECT data FROM {table} WHERE id = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, table, key, value):
+        with self.lock:
+            self.conn.execute(f"INSERT OR REPLACE INTO {table} (id, data) VALUES (?, ?)", (key, json.dumps(value)))
+            self.pending += 1
+            if self.pending >= self.COMMIT_SIZE: self.commitLocked()
+
+    def getTrack(self, track_id): return self.get('tracks', track_id)
+    def setTrack(self, track_id, value): self.set('tracks', track_id, value)
+    def getAlbum(self, album_id): return self.get('albums', album_id)
+    def setAlbum(self, album_id, value): self.set('albums', album_id, value)
+    def getDeezerTrackID(self, isrc): return self.get('isrcs', isrc)
+    def setDeezerTrackID(self, isrc, track_id): self.set('isrcs', isrc, track_id)
+
+    def commit(self):
+        with self.lock:
+            self.commitLocked()
+
+    def commitLocked(self):
+        self.conn.commit()
+        self.pending = 0
+
+    def importJSON(self, path):
+        try:
+            with open(path, 'r', encoding="utf-8") as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            cache = {}
+        with self.lock:
+            for table in ['tracks', 'albums']:
+                self.conn.executemany(f"INSERT OR IGNORE INTO {table} (id, data) VALUES (?, ?)",
+                    ((key, json.dumps(value)) for (key, value) in cache.get(table, {}).items()))
+            self.commitLocked()
+        path.rename(path.with_suffix('.json.bak'))
+
+class ISRCResolver:
+    """Finds the Deezer tracks of many ISRCs at once, concurrently.
+    ISRCs matched before are fetched by their Deezer id, so every track has the public API format."""
+    def __init__(self, dz, cache, workers=3):
+        self.dz = dz
+        self.cache = cache
+        self.workers = workers
+
+    def resolve(self, isrcs):
+        isrcs = list(dict.fromkeys(isrc for isrc in isrcs if isrc))
+        tracks = {}
+
+        with ThreadPoolExecutor(self.workers) as executor:
+            for (isrc, trackAPI) in zip(isrcs, executor.map(self.lookup, isrcs)):
+                if not trackAPI: continue
+                tracks[isrc] = trackAPI
+                self.cache.setDeezerTrackID(isrc, trackAPI['id'])
+        self.cache.commit()
+        return tracks
+
+    def lookup(self, isrc):
+        trackID = self.cache.getDeezerTrackID(isrc)
+        if trackID:
+            deezerAPIRateLimiter.wait()
+            try:
+                return self.dz.api.get_track(trackID)
+            except DataException:
+                pass
+        deezerAPIRateLimiter.wait()
+        try:
+            trackAPI = self.dz.api.get_track_by_ISRC(isrc)
+        except DataException:
+            return None
+        if 'id' not in trackAPI or 'title' not in trackAPI: return None
+        return trackAPI
+
 class Spotify(Plugin):
     def __init__(self, configFolder=None):
         super().__init__()
@@ -24,6 +127,9 @@ class Spotify(Plugin):
         }
         self.enabled = False
         self.sp = None
+        self.conversionLock = Lock()
+        self.cache = None
+        self.cacheLock = Lock()
         self.configFolder = Path(configFolder or getConfigFolder())
         self.configFolder /= 'spotify'
 
@@ -74,12 +180,11 @@ class Spotify(Plugin):
     def generateTrackItem(self, dz, link_id, bitrate):
         cache = self.loadCache()
 
-        if link_id in cache['tracks']:
-            cachedTrack = cache['tracks'][link_id]
-        else:
+        cachedTrack = cache.getTrack(link_id)
+        if not cachedTrack:
             cachedTrack = self.getTrack(link_id)
-            cache['tracks'][link_id] = cachedTrack
-            self.saveCache(cache)
+            cache.setTrack(link_id, cachedTrack)
+            cache.commit()
 
         if 'isrc' in cachedTrack:
             try: return generateTrackItem(dz, f"isrc:{cachedTrack['isrc']}", bitrate)
@@ -93,8 +198,8 @@ class Spotify(Plugin):
                 )
                 if trackID != "0":
                     cachedTrack['id'] = trackID
-                    cache['tracks'][link_id] = cachedTrack
-                    self.saveCache(cache)
+                    cache.setTrack(link_id, cachedTrack)
+                    cache.commit()
 
             if cachedTrack.get('id', "0") != "0":
                 return generateTrackItem(dz, cachedTrack['id'], bitrate)
@@ -104,27 +209,24 @@ class Spotify(Plugin):
     def generateAlbumItem(self, dz, link_id, bitrate):
         cache = self.loadCache()
 
-        if link_id in cache['albums']:
-            cachedAlbum = cache['albums'][link_id]
-        else:
+        cachedAlbum = cache.getAlbum(link_id)
+        if not cachedAlbum:
             cachedAlbum = self.getAlbum(link_id)
-            cache['albums'][link_id] = cachedAlbum
-            self.saveCache(cache)
+            cache.setAlbum(link_id, cachedAlbum)
+            cache.commit()
 
         try: return generateAlbumItem(dz, f"upc:{cachedAlbum['upc']}", bitrate)
         except GenerationError as e: raise AlbumNotOnDeezer(f"https://open.spotify.com/album/{link_id}") from e
 
     def generatePlaylistItem(self, dz, link_id, bitrate):
         if not self.enabled: raise Exception("Spotify plugin not enabled")
-        spotifyPlaylist = self.sp.playlist(link_id)
+        spotifyPlaylist = self.sp.playlist(link_id, fields=PLAYLIST_FIELDS)
 
         playlistAPI = self._convertPlaylistStructure(spotifyPlaylist)
-        playlistAPI['various_artist'] = dz.api.get_artist(5080) # Useful for save as compilation
+        playlistAPI['various_artist'] = getVariousArtist(dz) # Useful for save as compilation
 
         tracklistTemp = spotifyPlaylist['tracks']['items']
-        while spotifyPlaylist['tracks']['next']:
-            spotifyPlaylist['tracks'] = self.sp.next(spotifyPlaylist['tracks'])
-            tracklistTemp += spotifyPlaylist['tracks']['items']
+        tracklistTemp += self.getPlaylistItems(link_id, len(tracklistTemp), spotifyPlaylist['tracks']['total'])
 
         tracklist = []
         for item in tracklistTemp:
@@ -151,6 +253,13 @@ class Spotify(Plugin):
             'conversion_data': tracklist
         })
 
+    def getPlaylistItems(self, link_id, start, total):
+        # The total is known from the first page, so the other pages are fetched at the same time
+        offsets = range(start, total, PLAYLIST_PAGE_SIZE)
+        with ThreadPoolExecutor(PLAYLIST_FETCH_WORKERS) as executor:
+            pages = executor.map(lambda offset: self.sp.playlist_items(link_id, fields=PLAYLIST_ITEMS_FIELDS, limit=PLAYLIST_PAGE_SIZE, offset=offset, additional_types=('track',)), offsets)
+            return [item for page in pages for item in page['items']]
+
     def getTrack(self, track_id, spotifyTrack=None):
         if not self.enabled: raise Exception("Spotify plugin not enabled")
         cachedTrack = {
@@ -186,19 +295,21 @@ class Spotify(Plugin):
         }
         return cachedAlbum
 
-    def convertTrack(self, dz, downloadObject, track, pos, conversion, cache, listener):
+    def convertTrack(self, dz, downloadObject, track, pos, conversion, cache, listener, resolvedTracks=None):
         if downloadObject.isCanceled: return
         trackAPI = None
         cachedTrack = None
 
-        if track['id'] in cache['tracks']:
-            cachedTrack = cache['tracks'][track['id']]
-        else:
+        # The cache is committed once the whole conversion is done
+        cachedTrack = cache.getTrack(track['id'])
+        if not cachedTrack:
             cachedTrack = self.getTrack(track['id'], track)
-            cache['tracks'][track['id']] = cachedTrack
-            self.saveCache(cache)
+            cache.setTrack(track['id'], cachedTrack)
 
-        if 'isrc' in cachedTrack:
+        if resolvedTracks is not None:
+            # Tracks with the same ISRC share the resolved data, copy it before setting the position
+            if cachedTrack.get('isrc') in resolvedTracks: trackAPI = deepcopy(resolvedTracks[cachedTrack['isrc']])
+        elif 'isrc' in cachedTrack:
             try:
                 trackAPI = dz.api.get_track_by_ISRC(cachedTrack['isrc'])
                 if 'id' not in trackAPI or 'title' not in trackAPI: trackAPI = None
@@ -212,8 +323,7 @@ class Spotify(Plugin):
                 )
                 if trackID != "0":
                     cachedTrack['id'] = trackID
-                    cache['tracks'][track['id']] = cachedTrack
-                    self.saveCache(cache)
+                    cache.setTrack(track['id'], cachedTrack)
 
             if cachedTrack.get('id', "0") != "0":
                 trackAPI = dz.api.get_track(cachedTrack['id'])
@@ -237,10 +347,11 @@ class Spotify(Plugin):
             }
         trackAPI['position'] = pos+1
 
-        conversion['next'] += (1 / downloadObject.size) * 100
-        if round(conversion['next']) != conversion['now'] and round(conversion['next']) % 2 == 0:
-            conversion['now'] = round(conversion['next'])
-            if listener: listener.send("updateQueue", {'uuid': downloadObject.uuid, 'conversion': conversion['now']})
+        with self.conversionLock:
+            conversion['next'] += (1 / downloadObject.size) * 100
+            if round(conversion['next']) != conversion['now'] and round(conversion['next']) % 2 == 0:
+                conversion['now'] = round(conversion['next'])
+                if listener: listener.send("updateQueue", {'uuid': downloadObject.uuid, 'conversion': conversion['now']})
 
         return trackAPI
 
@@ -249,23 +360,34 @@ class Spotify(Plugin):
 
         conversion = { 'now': 0, 'next': 0 }
 
-        collection = [None] * len(downloadObject.conversion_data)
         if listener: listener.send("startConversion", downloadObject.uuid)
+
+        # Resolve every ISRC of the playlist up front
+        isrcs = []
+        for track in downloadObject.conversion_data:
+            cachedTrack = cache.getTrack(track['id'])
+            if not cachedTrack:
+                cachedTrack = self.getTrack(track['id'], track)
+                cache.setTrack(track['id'], cachedTrack)
+            isrcs.append(cachedTrack['isrc'])
+        resolvedTracks = ISRCResolver(dz, cache, settings['queueConcurrency']).resolve(isrcs)
+
         with ThreadPoolExecutor(settings['queueConcurrency']) as executor:
-            for pos, track in enumerate(downloadObject.conversion_data, start=0):
-                collection[pos] = executor.submit(self.convertTrack,
+            futures = [executor.submit(self.convertTrack,
                     dz, downloadObject,
                     track, pos,
                     conversion,
-                    cache, listener
-                ).result()
+                    cache, listener,
+                    resolvedTracks
+                ) for pos, track in enumerate(downloadObject.conversion_data, start=0)]
+            collection = [future.result() for future in futures]
 
         downloadObject.collection['tracks'] = collection
         downloadObject.size = len(collection)
         downloadObject = Collection(downloadObject.toDict())
         if listener: listener.send("finishConversion", downloadObject.getSlimmedDict())
 
-        self.saveCache(cache)
+        cache.commit()
         return downloadObject
 
     @classmethod
@@ -339,22 +461,13 @@ class Spotify(Plugin):
         self.settings = settings
 
     def loadCache(self):
-        cache = None
-        if (self.configFolder / 'cache.json').is_file():
-            with open(self.configFolder / 'cache.json', 'r', encoding="utf-8") as f:
-                try:
-                    cache = json.load(f)
-                except json.decoder.JSONDecodeError:
-                    self.saveCache({'tracks': {}, 'albums': {}})
-                    cache = None
-                except Exception:
-                    cache = None
-        if not cache: cache = {'tracks': {}, 'albums': {}}
-        return cache
-
-    def saveCache(self, newCache):
-        with open(self.configFolder / 'cache.json', 'w', encoding="utf-8") as spotifyCache:
-            json.dump(newCache, spotifyCache)
+        with self.cacheLock:
+            if not self.cache:
+                self.cache = SpotifyCache(self.configFolder / 'cache.db')
+                # Move the entries of the old whole file cache into the store
+                if (self.configFolder / 'cache.json').is_file():
+                    self.cache.importJSON(self.configFolder / 'cache.json')
+        return self.cache
 
     def checkCredentials(self):
         if self.credentials['clientId'] == "" or self.credentials['clientSecret'] == "":
@@ -4,6 +4,8 @@ from pathlib import Path
 from os import makedirs
 from deezer import TrackFormats
 import deemix.utils.localpaths as localpaths
+from deemix.utils.cache import artworkCache
+from deemix.utils.session import sessionPool
 
 class OverwriteOption():
     """Should the lib overwrite files?"""
@@ -38,6 +40,7 @@ DEFAULTS = {
   "paddingSize": "0",
   "illegalCharacterReplacer": "_",
   "queueConcurrency": 3,
+  "metadataConcurrency": 3,
   "maxBitrate": str(TrackFormats.MP3_320),
   "feelingLucky": False,
   "fallbackBitrate": False,
@@ -51,6 +54,7 @@ DEFAULTS = {
   "syncedLyrics": False,
   "embeddedArtworkSize": 800,
   "embeddedArtworkPNG": False,
+  "artworkCacheSize": 200,
   "localArtworkSize": 1400,
   "localArtworkFormat": "jpg",
   "saveArtwork": True,
@@ -66,6 +70,7 @@ DEFAULTS = {
   "titleCasing": "nothing",
   "artistCasing": "nothing",
   "executeCommand": "",
+  "streamTags": False,
   "tags": {
     "title": True,
     "artist": True,
@@ -126,8 +131,15 @@ def load(configFolder=None):
             settings = deepcopy(DEFAULTS)
 
     if check(settings) > 0: save(settings, configFolder) # Check the settings and save them if something changed
+    configureShared(settings)
     return settings
 
+def configureShared(settings):
+    # The artwork cache and the session pool are shared by every Downloader of the process
+    artworkCache.maxBytes = settings['artworkCacheSize'] * 1024 * 1024
+    # Track streams, URL probes and images can all be in flight at once
+    sessionPool.setPoolSize(settings['queueConcurrency'] + settings['metadataConcurrency'])
+
 def check(settings):
     changes = 0
     for i_set in DEFAULTS:
@@ -1,16 +1,48 @@
-from mutagen.flac import FLAC, Picture
+from io import BytesIO
+import struct
+
+from mutagen.flac import FLAC, Picture, VCFLACDict, FLACNoHeaderError
 from mutagen.id3 import ID3, ID3NoHeaderError, \
     TXXX, TIT2, TPE1, TALB, TPE2, TRCK, TPOS, TCON, TYER, TDAT, TLEN, TBPM, \
     TPUB, TSRC, USLT, SYLT, APIC, IPLS, TCOM, TCOP, TCMP, Encoding, PictureType, POPM
 
-# Adds tags to a MP3 file
-def tagID3(path, track, save):
-    # Delete existing tags
-    try:
-        tag = ID3(path)
-        tag.delete()
-    except ID3NoHeaderError:
-        tag = ID3()
+from deemix.utils.cache import artworkCache
+
+# Free space left after the tags, so they can be edited later without rewriting the audio
+TAG_PADDING = 4096
+
+# Size of the ID3v2 tag starting with this 10 bytes header, 0 if it isn't one
+def getID3Size(header):
+    if header[:3] != b"ID3": return 0
+    (flags, size) = struct.unpack('>B4s', header[5:10])
+    size = 10 + sum(byte << (7 * (3 - i)) for i, byte in enumerate(size))
+    if flags & 0x10: size += 10 # Footer
+    return size
+
+# Builds the 128 bytes ID3v1 tag from the ID3v2 frames
+def renderID3v1(tag):
+    def field(frameIds, length):
+        for frameId in frameIds:
+            frames = tag.getall(frameId)
+            if frames: return "/".join(str(text) for text in frames[0].text).encode('latin1', 'replace')[:length].ljust(length, b"\x00")
+        return b"\x00" * length
+
+    trackNumber = tag.getall('TRCK')
+    trackNumber = str(trackNumber[0].text[0]).split("/")[0] if trackNumber else "0"
+    trackNumber = int(trackNumber) if trackNumber.isdigit() and int(trackNumber) < 256 else 0
+    return b"".join([
+        b"TAG",
+        field(['TIT2'], 30),
+        field(['TPE1'], 30),
+        field(['TALB'], 30),
+        field(['TYER', 'TDRC'], 4),
+        b"\x00" * 29, # Comment
+        bytes([trackNumber, 255]) # Unknown genre
+    ])
+
+# Builds the ID3 tags of a track
+def buildID3(track, save):
+    tag = ID3()
 
     if save['title']:
         tag.add(TIT2(text=track.title))
@@ -119,20 +151,28 @@ def tagID3(path, track, save):
         if str(track.album.embeddedCoverPath).endswith('png'):
             mimeType = 'image/png'
 
-        with open(track.album.embeddedCoverPath, 'rb') as f:
-            tag.add(APIC(descEncoding, mimeType, PictureType.COVER_FRONT, desc='cover', data=f.read()))
+        tag.add(APIC(descEncoding, mimeType, PictureType.COVER_FRONT, desc='cover', data=artworkCache.read(track.album.embeddedCoverPath)))
 
+    return tag
+
+# Adds tags to a MP3 file
+def tagID3(path, track, save):
+    # Delete existing tags
+    try:
+        ID3(path).delete()
+    except ID3NoHeaderError:
+        pass
+
+    tag = buildID3(track, save)
     tag.save( path,
               v1=2 if save['saveID3v1'] else 0,
               v2_version=3,
               v23_sep=None if save['useNullSeparator'] else '/' )
 
-# Adds tags to a FLAC file
-def tagFLAC(path, track, save):
-    # Delete existing tags
-    tag = FLAC(path)
-    tag.delete()
-    tag.clear_pictures()
+# Builds the vorbis comments and the pictures of a track
+def buildFLACTags(track, save):
+    tag = VCFLACDict()
+    pictures = []
 
     if save['title']:
         tag["TITLE"] = track.title
@@ -222,8 +262,117 @@ def tagFLAC(path, track, save):
         image.mime = 'image/jpeg'
         if str(track.album.embeddedCoverPath).endswith('png'):
             image.mime = 'image/png'
-        with open(track.album.embeddedCoverPath, 'rb') as f:
-            image.data = f.read()
+        image.data = artworkCache.read(track.album.embeddedCoverPath)
+        pictures.append(image)
+
+    return (tag, pictures)
+
+# Adds tags to a FLAC file
+def tagFLAC(path, track, save):
+    # Delete existing tags
+    tag = FLAC(path)
+    tag.delete()
+    tag.clear_pictures()
+
+    (comments, pictures) = buildFLACTags(track, save)
+    # Copy the comments as they are, keys() would lowercase and reorder them
+    if tag.tags is None: tag.add_tags()
+    tag.tags.extend(comments)
+    for image in pictures:
         tag.add_picture(image)
 
     tag.save(deleteid3=True)
+
+class ID3TagStream:
+    """Output stream that writes the ID3 tags before the MP3 audio written to it"""
+    def __init__(self, stream, track, save):
+        self.stream = stream
+        self.save = save
+        self.tag = buildID3(track, save)
+        self.pending = b""
+        self.skip = 0
+        self.started = False
+
+    def writeHeader(self):
+        header = BytesIO()
+        self.tag.save(header, v1=0, v2_version=3,
+                      v23_sep=None if self.save['useNullSeparator'] else '/',
+                      padding=lambda info: TAG_PADDING)
+        self.stream.write(header.getvalue())
+        self.started = True
+
+    def write(self, data):
+        if not self.started:
+            # Drop the tags already present in the stream
+            self.pending += bytes(data)
+            if len(self.pending) < 10: return
+            self.skip = getID3Size(self.pending[:10])
+            self.writeHeader()
+            (data, self.pending) = (self.pending, b"")
+        if self.skip:
+            skipped = min(self.skip, len(data))
+            data = data[skipped:]
+            self.skip -= skipped
+        if data: self.stream.write(data)
+
+    def close(self):
+        if not self.started:
+            self.writeHeader()
+            self.stream.write(self.pending)
+        if self.save['saveID3v1']: self.stream.write(renderID3v1(self.tag))
+
+class FLACTagStream:
+    """Output stream that writes the FLAC metadata blocks, with tags and cover, before the audio frames written to it"""
+    def __init__(self, stream, track, save):
+        self.stream = stream
+        (self.comments, self.pictures) = buildFLACTags(track, save)
+        self.pending = b""
+        self.skip = None
+        self.blocks = []
+        self.started = False
+
+    def write(self, data):
+        if self.started:
+            self.stream.write(data)
+            return
+        self.pending += bytes(data)
+        # Drop an ID3 tag in front of the FLAC stream, like tagFLAC does with deleteid3
+        if self.skip is None:
+            if len(self.pending) < 10: return
+            self.skip = getID3Size(self.pending[:10])
+        if self.skip:
+            if len(self.pending) < self.skip: return
+            self.pending = self.pending[self.skip:]
+            self.skip = 0
+        if len(self.pending) >= 4 and self.pending[:4] != b"fLaC": raise FLACNoHeaderError("stream is not a FLAC file")
+
+        # Read the metadata blocks of the stream, they're rewritten once the last one is complete
+        offset = 4 + sum(4 + len(block) for (_, block) in self.blocks)
+        while len(self.pending) >= offset + 4:
+            blockHeader = struct.unpack('>I', self.pending[offset:offset+4])[0]
+            (code, length) = (blockHeader >> 24, blockHeader & 0xffffff)
+            if len(self.pending) < offset + 4 + length: return
+            self.blocks.append((code & 0x7f, self.pending[offset+4:offset+4+length]))
+            offset += 4 + length
+            if code & 0x80:
+                self.stream.write(self.renderHeader())
+                self.stream.write(self.pending[offset:])
+                self.started = True
+                self.pending = b""
+                return
+
+    def renderHeader(self):
+        # Keep the stream info blocks, drop the old comments (4), pictures (6) and padding (1)
+        blocks = [block for block in self.blocks if block[0] not in [1, 4, 6]]
+        blocks.append((4, self.comments.write(framing=False)))
+        blocks.extend((6, image.write()) for image in self.pictures)
+        blocks.append((1, b"\x00" * TAG_PADDING))
+        header = [b"fLaC"]
+        for i, (code, block) in enumerate(blocks):
+            if i == len(blocks) - 1: code |= 0x80 # Last metadata block flag
+            header.append(struct.pack('>I', (code << 24) | len(block)))
+            header.append(block)
+        return b"".join(header)
+
+    def close(self):
+        if not self.started: raise FLACNoHeaderError("stream ended before the FLAC metadata")
@@ -6,6 +6,7 @@ from deezer.errors import APIError, GWAPIError
 from deemix.errors import NoDataToParse, AlbumDoesntExists
 
 from deemix.utils import removeFeatures, andCommaConcat, removeDuplicateArtists, generateReplayGainString, changeCase
+from deemix.utils.cache import albumCache, albumGWCache, artistCache
 
 from deemix.types.Album import Album
 from deemix.types.Artist import Artist
@@ -28,6 +29,7 @@ class Track:
         self.duration = 0
         self.fallbackID = "0"
         self.albumsFallback = []
+        self.albumsFallbackLoaded = False
         self.filesizes = {}
         self.local = False
         self.mainArtist = None
@@ -109,14 +111,14 @@ class Track:
 
             # Get album Data
             if not albumAPI:
-                try: albumAPI = dz.api.get_album(self.album.id)
+                try: albumAPI = albumCache.fetch(self.album.id, dz.api.get_album)
                 except APIError: albumAPI = None
 
             # Get album_gw Data
             # Only gw has disk number
             if not albumAPI or albumAPI and not albumAPI.get('nb_disk'):
                 try:
-                    albumAPI_gw = dz.gw.get_album(self.album.id)
+                    albumAPI_gw = albumGWCache.fetch(self.album.id, dz.gw.get_album)
                     albumAPI_gw = map_album(albumAPI_gw)
                 except GWAPIError: albumAPI_gw = {}
                 if not albumAPI: albumAPI = {}
@@ -130,7 +132,7 @@ class Track:
             # Getting artist image ID
             # ex: https://e-cdns-images.dzcdn.net/images/artist/f2bc007e9133c946ac3c3907ddc5d2ea/56x56-000000-80-0-0.jpg
             if not self.album.mainArtist.pic.md5 or self.album.mainArtist.pic.md5 == "":
-                artistAPI = dz.api.get_artist(self.album.mainArtist.id)
+                artistAPI = artistCache.fetch(self.album.mainArtist.id, dz.api.get_artist)
                 self.album.mainArtist.pic.md5 = artistAPI['picture_small'][artistAPI['picture_small'].find('artist/') + 7:-24]
 
             # Fill missing data
@@ -217,11 +219,24 @@ class Track:
                     self.artist[artist['role']] = []
                 self.artist[artist['role']].append(artist['name'])
 
+        self.parseAlbumsFallback(trackAPI)
+
+    def parseAlbumsFallback(self, trackAPI):
+        # Only the track page has the alternative albums, song.getListData doesn't
+        self.albumsFallbackLoaded = 'alternative_albums' in trackAPI
         if trackAPI.get('alternative_albums'):
             for album in trackAPI['alternative_albums']['data']:
                 if 'RIGHTS' in album and album['RIGHTS'].get('STREAM_ADS_AVAILABLE') or album['RIGHTS'].get('STREAM_SUB_AVAILABLE'):
                     self.albumsFallback.append(album['ALB_ID'])
 
+    def loadAlbumsFallback(self, dz):
+        # Get the alternative albums of tracks parsed without the track page
+        if self.albumsFallbackLoaded: return
+        self.albumsFallbackLoaded = True
+        try: trackAPI_gw = dz.gw.get_track_page(self.id)
+        except GWAPIError: return
+        if 'ISRC' in trackAPI_gw: self.parseAlbumsFallback({'alternative_albums': trackAPI_gw['ISRC']})
+
     def removeDuplicateArtists(self):
         (self.artist, self.artists) = removeDuplicateArtists(self.artist, self.artists)
 
@@ -0,0 +1,162 @@
+from collections import OrderedDict
+from copy import deepcopy
+import json
+from os import makedirs, utime
+from pathlib import Path
+from tempfile import gettempdir
+from threading import Lock
+from time import time
+
+from deemix.utils.localpaths import getConfigFolder
+
+class MetadataCache:
+    """Thread safe LRU cache of API payloads, entries expire after ttl seconds"""
+    def __init__(self, maxSize=1000, ttl=3600, persistent=False):
+        self.maxSize = maxSize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = Lock()
+        # Persistent caches are saved to path, defaults to a file in the config folder
+        self.persistent = persistent
+        self.path = None
+        self.loaded = False
+
+    def getPath(self):
+        return self.path or getConfigFolder() / 'entityCache.json'
+
+    def load(self):
+        self.loaded = True
+        if not self.persistent or not self.getPath().is_file(): return
+        try:
+            with open(self.getPath(), 'r', encoding="utf-8") as f:
+                self.entries = OrderedDict((key, tuple(entry)) for (key, entry) in json.load(f).items())
+        except (OSError, ValueError):
+            self.entries = OrderedDict()
+
+    def save(self):
+        if not self.persistent: return
+        try:
+            with open(self.getPath(), 'w', encoding="utf-8") as f:
+                json.dump(self.entries, f)
+        except OSError:
+            pass
+
+    def get(self, key):
+        key = str(key)
+        with self.lock:
+            if not self.loaded: self.load()
+            entry = self.entries.get(key)
+            if entry and time() - entry[1] < self.ttl:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                # Callers update the payloads they get, never hand out the cached object
+                return deepcopy(entry[0])
+            if entry: del self.entries[key]
+            self.misses += 1
+            return None
+
+    def set(self, key, value):
+        with self.lock:
+            if not self.loaded: self.load()
+            self.entries[str(key)] = (deepcopy(value), time())
+            self.entries.move_to_end(str(key))
+            while len(self.entries) > self.maxSize:
+                self.entries.popitem(last=False)
+            self.save()
+
+    def fetch(self, key, fetcher):
+        value = self.get(key)
+        if value is None:
+            value = fetcher(key)
+            if value is not None: self.set(key, value)
+        return value
+
+    def getStats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries)}
+
+class ArtworkCache:
+    """Folder of downloaded images kept under maxBytes, least recently used first out.
+    The last hotSize images read are also kept in memory."""
+    def __init__(self, folder, maxBytes=200*1024*1024, hotSize=16):
+        self.folder = Path(folder)
+        self.maxBytes = maxBytes
+        self.hotSize = hotSize
+        self.files = OrderedDict()
+        self.hot = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.hotHits = 0
+        self.loaded = False
+        self.lock = Lock()
+
+    def load(self):
+        # Recover the files and their usage order from a previous run
+        self.loaded = True
+        makedirs(self.folder, exist_ok=True)
+        files = sorted((f.stat().st_mtime, f.name, f.stat().st_size) for f in self.folder.iterdir() if f.is_file() and f.suffix != ".tmp")
+        self.files = OrderedDict((name, size) for (_, name, size) in files)
+
+    def fetch(self, name, download):
+        # download(path) writes the image to path and returns it, or None on failure
+        path = self.folder / name
+        with self.lock:
+            if not self.loaded: self.load()
+            if name in self.files and path.is_file():
+                self.files.move_to_end(name)
+                self.hits += 1
+                utime(path)
+                return path
+            self.misses += 1
+        path = download(path)
+        if path and path.is_file():
+            with self.lock:
+                self.files[name] = path.stat().st_size
+                self.files.move_to_end(name)
+                self.evict()
+        return path
+
+    def evict(self):
+        total = sum(self.files.values())
+        while total > self.maxBytes and len(self.files) > 1:
+            (name, size) = self.files.popitem(last=False)
+            total -= size
+            self.hot.pop(str(self.folder / name), None)
+            (self.folder / name).unlink(missing_ok=True)
+
+    def read(self, path):
+        key = str(path)
+        with self.lock:
+            if key in self.hot:
+                self.hot.move_to_end(key)
+                self.hotHits += 1
+                return self.hot[key]
+        with open(path, 'rb') as f:
+            data = f.read()
+        with self.lock:
+            self.hot[key] = data
+            while len(self.hot) > self.hotSize:
+                self.hot.popitem(last=False)
+        return data
+
+    def getStats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hitRate': round(self.hits / lookups, 3) if lookups else 0,
+                'hotHits': self.hotHits,
+                'files': len(self.files),
+                'bytes': sum(self.files.values())
+            }
+
+# Shared by every Downloader of the process
+albumCache = MetadataCache()
+albumGWCache = MetadataCache()
+artistCache = MetadataCache()
+# Constant entities like the Various Artists artist, kept across restarts
+entityCache = MetadataCache(maxSize=100, ttl=86400, persistent=True)
+artworkCache = ArtworkCache(Path(gettempdir()) / 'deemix-imgs')
@@ -2,6 +2,12 @@ import binascii
 
 from Cryptodome.Cipher import Blowfish, AES
 from Cryptodome.Hash import MD5
+from Cryptodome.Util.strxor import strxor
+
+BLOWFISH_IV = b"\x00\x01\x02\x03\x04\x05\x06\x07"
+# Every stripe of 6144 bytes starts with a 2048 bytes encrypted block
+ENCRYPTED_BLOCK_SIZE = 2048
+STRIPE_SIZE = ENCRYPTED_BLOCK_SIZE * 3
 
 def _md5(data):
     h = MD5.new()
@@ -23,4 +29,22 @@ def generateBlowfishKey(trackId):
     return str.encode(bfKey)
 
 def decryptChunk(key, data):
-    return Blowfish.new(key, Blowfish.MODE_CBC, b"\x00\x01\x02\x03\x04\x05\x06\x07").decrypt(data)
+    return Blowfish.new(key, Blowfish.MODE_CBC, BLOWFISH_IV).decrypt(data)
+
+class StripeDecryptor:
+    """Decrypts a track stream in place, computing the Blowfish key schedule once per track"""
+    def __init__(self, key):
+        # Each block is CBC encrypted with the same IV, CBC is done by hand on top of ECB
+        # so that a single cipher can be reused for every block
+        self.cipher = Blowfish.new(key, Blowfish.MODE_ECB)
+        self.previous = bytearray(ENCRYPTED_BLOCK_SIZE)
+        self.previous[:8] = BLOWFISH_IV
+        self.decrypted = bytearray(ENCRYPTED_BLOCK_SIZE)
+
+    def decrypt(self, buffer):
+        # buffer must be a writable memoryview starting at a stripe boundary
+        for start in range(0, len(buffer) - ENCRYPTED_BLOCK_SIZE + 1, STRIPE_SIZE):
+            block = buffer[start:start + ENCRYPTED_BLOCK_SIZE]
+            self.previous[8:] = block[:-8]
+            self.cipher.decrypt(block, output=self.decrypted)
+            strxor(self.decrypted, self.previous, output=block)
@@ -0,0 +1,22 @@
+from collections import deque
+from threading import Lock
+from time import monotonic, sleep
+
+class RateLimiter:
+    """Blocks callers so that at most maxCalls happen every period seconds"""
+    def __init__(self, maxCalls, period):
+        self.maxCalls = maxCalls
+        self.period = period
+        self.calls = deque()
+        self.lock = Lock()
+
+    def wait(self):
+        with self.lock:
+            while len(self.calls) >= self.maxCalls:
+                elapsed = monotonic() - self.calls[0]
+                if elapsed >= self.period: self.calls.popleft()
+                else: sleep(self.period - elapsed)
+            self.calls.append(monotonic())
+
+# Deezer allows 50 API requests every 5 seconds, shared by every caller of the process
+deezerAPIRateLimiter = RateLimiter(50, 5)
@@ -0,0 +1,59 @@
+from threading import Lock, local
+
+from requests import Session
+from requests.adapters import HTTPAdapter
+
+from deemix.utils import USER_AGENT_HEADER
+
+class SessionPool:
+    """Keep-alive sessions for the CDN and image requests.
+    Each thread gets its own Session, all of them share the connection pools of one adapter."""
+    def __init__(self, poolSize=10, hosts=10):
+        self.hosts = hosts
+        self.poolSize = None
+        self.adapter = None
+        self.sessions = local()
+        self.lock = Lock()
+        self.setPoolSize(poolSize)
+
+    def setPoolSize(self, poolSize):
+        # Meant to be set once at startup, the replaced adapter is closed with its idle connections
+        # Sessions made before a resize get a new adapter on their next request
+        with self.lock:
+            if poolSize == self.poolSize: return
+            self.poolSize = poolSize
+            (oldAdapter, self.adapter) = (self.adapter, HTTPAdapter(pool_connections=self.hosts, pool_maxsize=poolSize))
+            if oldAdapter: oldAdapter.close()
+
+    def getSession(self):
+        session = getattr(self.sessions, 'session', None)
+        if session is None or session.adapters['https://'] is not self.adapter:
+            session = Session()
+            session.headers['User-Agent'] = USER_AGENT_HEADER
+            session.mount('https://', self.adapter)
+            session.mount('http://', self.adapter)
+            self.sessions.session = session
+        return session
+
+    def get(self, url, **kwargs):
+        return self.getSession().get(url, **kwargs)
+
+    def head(self, url, **kwargs):
+        return self.getSession().head(url, **kwargs)
+
+    def getStats(self):
+        stats = {}
+        pools = self.adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools[key]
+            if pool is None: continue
+            stats[pool.host] = {
+                'connections': pool.num_connections,
+                'requests': pool.num_requests,
+                'inUse': pool.pool.maxsize - pool.pool.qsize() if pool.pool else 0,
+                'maxSize': pool.pool.maxsize if pool.pool else 0
+            }
+        return stats
+
+# Shared by every Downloader of the process
+sessionPool = SessionPool()
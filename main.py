@@ -1,17 +1,25 @@
-from deemix.downloader import Downloader
+from deemix.downloader import Downloader, TrackURLResolver
 from deemix import generateDownloadObject
-from deemix.itemgen import GenerationError
+from deemix.itemgen import GenerationError, generateTrackItems
 from deemix.settings import load as load_deemix_settings
+from deemix.utils.cache import albumCache, artistCache, artworkCache, entityCache
+from deemix.utils.ratelimit import deezerAPIRateLimiter as deezer_api_rate_limiter
+from deemix.utils.session import sessionPool
 
 from deezer import Deezer as deemixDeezer
 
 from plexapi.myplex import MyPlexAccount
+from plexapi.utils import searchType
 
 import yaml
 
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+import json
 import os
 import shutil
+import sqlite3
 import time
 
 import logging
@@ -73,15 +81,118 @@ def load_deezync_config():
 # Deemix
 deemix_folder = Path('/config/deemix')
 settings = load_deemix_settings(deemix_folder)
+entityCache.path = deemix_folder / 'entityCache.json'
 downloadArl = load_download_arl()
 
 # login to deezer download account
 dz: deemixDeezer = deezer_login()
 plex_server = None
 
-downloaded_tracks = []
+# download attempts by Deezer track id, oldest first
+download_history = OrderedDict()
 cached_deezer_playlists = {}
 playlist_last_sync_time = {}
+# Plex rating key matched to each Deezer track, by playlist id
+playlist_match_results = {}
+
+state_db_path = Path('/config/deezync.db')
+state_db = None
+
+library_snapshot_path = Path('/config/plex_library.json')
+library_snapshot = None
+library_snapshot_unsaved = False
+# the changes query and the library size can't tell every deletion apart, refetch the whole library once a day
+library_full_refresh_interval = 24 * 60 * 60
+
+
+def load_sync_state():
+    global state_db
+
+    state_db = sqlite3.connect(state_db_path)
+    with state_db:
+        state_db.execute("CREATE TABLE IF NOT EXISTS playlists "
+                         "(id INTEGER PRIMARY KEY, checksum TEXT, last_sync_time REAL)")
+        state_db.execute("CREATE TABLE IF NOT EXISTS downloads "
+                         "(track_id INTEGER PRIMARY KEY, outcome TEXT, attempted_at REAL, retries INTEGER DEFAULT 0)")
+        # add retry count to download history of older versions
+        if 'retries' not in [column[1] for column in state_db.execute("PRAGMA table_info(downloads)")]:
+            state_db.execute("ALTER TABLE downloads ADD COLUMN retries INTEGER DEFAULT 0")
+        state_db.execute("CREATE TABLE IF NOT EXISTS match_results "
+                         "(playlist_id INTEGER, deezer_track_id INTEGER, rating_key INTEGER, "
+                         "PRIMARY KEY (playlist_id, deezer_track_id))")
+
+    for playlist_id, checksum, last_sync_time in state_db.execute("SELECT * FROM playlists"):
+        cached_deezer_playlists[playlist_id] = checksum
+        playlist_last_sync_time[playlist_id] = last_sync_time
+    for track_id, outcome, attempted_at, retries in state_db.execute(
+            "SELECT track_id, outcome, attempted_at, retries FROM downloads ORDER BY attempted_at"):
+        download_history[track_id] = {'outcome': outcome, 'attempted_at': attempted_at, 'retries': retries}
+    evict_download_history()
+    for playlist_id, deezer_track_id, rating_key in state_db.execute(
+            "SELECT * FROM match_results WHERE rating_key IS NOT NULL"):
+        playlist_match_results.setdefault(playlist_id, {})[deezer_track_id] = rating_key
+
+    logging.info(f"Loaded sync state of {len(cached_deezer_playlists)} playlists and "
+                 f"{len(download_history)} download attempts")
+
+
+def save_playlist_state(playlist_ids):
+    with state_db:
+        state_db.executemany("INSERT OR REPLACE INTO playlists VALUES (?, ?, ?)", [
+            (playlist_id, cached_deezer_playlists.get(playlist_id), playlist_last_sync_time.get(playlist_id))
+            for playlist_id in playlist_ids])
+
+
+def should_download(track_id):
+    attempt = download_history.get(track_id)
+    if not attempt:
+        return True
+    if attempt['outcome'] != 'failed' or attempt['retries'] >= config.get('download_max_retries', 3):
+        return False
+
+    # retry failed downloads with exponential backoff
+    backoff_seconds = config.get('download_retry_seconds', 86400) * 2 ** attempt['retries']
+    return time.time() - attempt['attempted_at'] >= backoff_seconds
+
+
+def save_download_outcome(track_id, outcome):
+    attempt = download_history.pop(track_id, None)
+    attempt = {
+        'outcome': outcome,
+        'attempted_at': time.time(),
+        'retries': attempt['retries'] + 1 if attempt else 0
+    }
+    download_history[track_id] = attempt
+
+    with state_db:
+        state_db.execute("INSERT OR REPLACE INTO downloads VALUES (?, ?, ?, ?)",
+                         (track_id, attempt['outcome'], attempt['attempted_at'], attempt['retries']))
+    evict_download_history()
+
+
+def evict_download_history():
+    # forget the oldest attempts, evicted tracks are downloaded again if still missing
+    evicted_track_ids = []
+    while len(download_history) > config.get('download_history_size', 10000):
+        evicted_track_ids.append(download_history.popitem(last=False)[0])
+
+    if evicted_track_ids:
+        with state_db:
+            state_db.executemany("DELETE FROM downloads WHERE track_id = ?",
+                                 [(track_id,) for track_id in evicted_track_ids])
+
+
+def save_match_results(playlist_id, match_results, replace=True):
+    if replace:
+        playlist_match_results[playlist_id] = {}
+    playlist_match_results.setdefault(playlist_id, {}).update(
+        {deezer_track_id: rating_key for deezer_track_id, rating_key in match_results.items() if rating_key})
+
+    with state_db:
+        if replace:
+            state_db.execute("DELETE FROM match_results WHERE playlist_id = ?", (playlist_id,))
+        state_db.executemany("INSERT OR REPLACE INTO match_results VALUES (?, ?, ?)", [
+            (playlist_id, deezer_track_id, rating_key) for deezer_track_id, rating_key in match_results.items()])
 
 
 def connect_plex():
@@ -102,21 +213,264 @@ def connect_plex():
         logging.info(f"Connected to Plex server {config['plex_server']}")
 
 
+def normalize_title(title):
+    return str(title).lower()
+
+
+def normalize_artist(name):
+    return str(name).replace('’', '\'').lower()
+
+
+def deezer_title_keys(title):
+    # Deemix replaces some characters in file names, which Plex then uses as title
+    # the raw title is tried first, dict.fromkeys drops the duplicate when no character was replaced
+    title = normalize_title(title)
+    return tuple(dict.fromkeys((title, title.replace('?', '_').replace('/', '_').replace('[', '(').replace(']', ')'))))
+
+
+def library_track_record(track):
+    # read the fields from the bulk track listing: track.artist() fetches the artist from Plex and plexapi
+    # reloads the whole track when an attribute like originalTitle is missing, both would be a request per track
+    attributes = track._data.attrib
+    return {
+        'title': normalize_title(attributes.get('title', '')),
+        'artist': normalize_artist(attributes.get('grandparentTitle', '')),
+        'original_title': normalize_artist(attributes.get('originalTitle', '')),
+        'album': attributes.get('parentTitle', ''),
+        'file': track.locations[0] if track.locations else None,
+        'updated_at': int(attributes.get('updatedAt', 0))
+    }
+
+
+def load_library_snapshot():
+    if not library_snapshot_path.is_file():
+        return None
+
+    try:
+        with open(library_snapshot_path, 'r', encoding="utf-8") as f:
+            snapshot = json.load(f)
+    except (OSError, json.decoder.JSONDecodeError) as e:
+        logging.warning(f"Couldn't load Plex library snapshot, doing a full refresh: {e}")
+        return None
+
+    if snapshot.get('library') != config['plex_library']:
+        return None
+
+    # JSON object keys are strings, Plex rating keys are ints
+    snapshot['tracks'] = {int(rating_key): record for rating_key, record in snapshot['tracks'].items()}
+    return snapshot
+
+
+def save_library_snapshot(snapshot):
+    global library_snapshot_unsaved
+
+    temp_path = library_snapshot_path.with_suffix('.tmp')
+    with open(temp_path, 'w', encoding="utf-8") as f:
+        json.dump(snapshot, f, separators=(',', ':'))
+    os.replace(temp_path, library_snapshot_path)
+    library_snapshot_unsaved = False
+# the changes query and the library size can't tell every deletion apart, refetch the whole library once a day
+library_full_refresh_interval = 24 * 60 * 60
+
+
+def refresh_library_snapshot(check_size=True, save=True):
+    # check_size=False only applies the changes query, save=False leaves saving to a later call
+    global library_snapshot, library_snapshot_unsaved
+
+    section = plex_server.library.section(config['plex_library'])
+
+    if library_snapshot is None:
+        library_snapshot = load_library_snapshot()
+    if (library_snapshot is not None and check_size
+            and time.time() - library_snapshot.get('full_refresh_at', 0) > library_full_refresh_interval):
+        logging.info("Plex library snapshot is due for a full refresh")
+        library_snapshot = None
+
+    library_tracks = None
+    if library_snapshot is not None:
+        # only fetch tracks changed since the newest change in the snapshot, new tracks have updatedAt set too
+        try:
+            library_tracks = section.fetchItems(f"/library/sections/{section.key}/all?type={searchType('track')}"
+                                                f"&updatedAt>>={library_snapshot['updated_at'] - 1}")
+        except Exception as e:
+            logging.warning(f"Couldn't fetch Plex library changes, doing a full refresh: {e}")
+
+    # deleted tracks don't show up in the changes, do a full refresh if the library size doesn't add up
+    if library_tracks is not None and check_size:
+        new_tracks = {track.ratingKey for track in library_tracks} - library_snapshot['tracks'].keys()
+        if section.totalViewSize(libtype='track') != len(library_snapshot['tracks']) + len(new_tracks):
+            logging.info("Plex library snapshot is out of date, doing a full refresh")
+            library_tracks = None
+
+    if library_tracks is None:
+        logging.info("Fetching full Plex library...")
+        library_tracks = section.all(libtype='track')
+        library_snapshot = {'library': config['plex_library'], 'updated_at': 0, 'full_refresh_at': time.time(),
+                            'tracks': {}}
+
+    changed_count = 0
+    for track in library_tracks:
+        record = library_track_record(track)
+        # the changes query also returns the newest tracks again, only count records that differ
+        if library_snapshot['tracks'].get(track.ratingKey) != record:
+            changed_count += 1
+        library_snapshot['tracks'][track.ratingKey] = record
+        library_snapshot['updated_at'] = max(library_snapshot['updated_at'], record['updated_at'])
+
+    # rewriting the snapshot is expensive for large libraries, skip it when nothing changed
+    if changed_count:
+        library_snapshot_unsaved = True
+        logging.info(f"Refreshed Plex library snapshot with {changed_count} changed tracks, "
+                     f"{len(library_snapshot['tracks'])} tracks total")
+    if save and library_snapshot_unsaved:
+        save_library_snapshot(library_snapshot)
+    return library_snapshot['tracks']
+
+
+def fetch_plex_tracks(rating_keys, batch_size=500):
+    # fetch matched tracks in bulk to get Plex objects that can be added to playlists
+    global library_snapshot_unsaved
+
+    tracks = []
+    rating_keys = list(rating_keys)
+    for i in range(0, len(rating_keys), batch_size):
+        tracks.extend(plex_server.fetchItems(rating_keys[i:i + batch_size]))
+
+    tracks_by_key = {track.ratingKey: track for track in tracks}
+
+    # tracks deleted from Plex since the last refresh can't be fetched, drop them from the snapshot
+    stale_rating_keys = [rating_key for rating_key in rating_keys if rating_key not in tracks_by_key]
+    if stale_rating_keys:
+        for rating_key in stale_rating_keys:
+            library_snapshot['tracks'].pop(rating_key, None)
+        library_snapshot_unsaved = True
+        logging.info(f"Removed {len(stale_rating_keys)} deleted tracks from Plex library snapshot")
+
+    return [tracks_by_key[rating_key] for rating_key in rating_keys if rating_key in tracks_by_key]
+
+
+def build_library_index(library_tracks):
+    # index Plex tracks by normalized title, so a Deezer track is matched with a single lookup
+    index = {}
+    for rating_key, record in library_tracks.items():
+        index.setdefault(record['title'], []).append((rating_key, (record['artist'], record['original_title'])))
+
+    logging.debug(f"Indexed {len(library_tracks)} Plex tracks by {len(index)} titles")
+    return index
+
+
+def find_library_track(library_index, deezer_track, excluded_rating_keys=()):
+    artist_name = normalize_artist(deezer_track['artist']['name'])
+
+    for title in deezer_title_keys(deezer_track['title']):
+        for rating_key, artists in library_index.get(title, []):
+            if rating_key in excluded_rating_keys:
+                continue
+            if any(artist_name in artist for artist in artists):
+                return rating_key
+
+    return None
+
+
+def get_playlist_config(playlist_id):
+    for playlist_config in deezer_playlist_configs:
+        if playlist_config['id'] == playlist_id:
+            return playlist_config
+    return None
+
+
+def find_plex_playlist(title):
+    for playlist in plex_server.playlists():
+        if playlist.title == title:
+            return playlist
+    return None
+
+
+def add_to_plex_playlist(plex_playlist, deezer_playlist, playlist_config, plex_tracks):
+    if plex_playlist:
+        plex_playlist.addItems(plex_tracks)
+    else:
+        # if the playlist does not exist, create it
+        plex_playlist = plex_server.createPlaylist(deezer_playlist['title'], items=plex_tracks)
+        logging.info(f"Created Plex playlist: {deezer_playlist['title']}")
+
+    # update playlist cover
+    if playlist_config['sync_cover_description'] == 1:
+        plex_playlist.uploadPoster(deezer_playlist['picture_xl'])
+        # update description
+        if deezer_playlist['description']:
+            plex_playlist.editSummary(deezer_playlist['description'])
+
+    return plex_playlist
+
+
+def resolve_downloaded_track(section, deezer_track, paths, files_index):
+    # find the downloaded file in Plex by its path
+    for path in paths:
+        for plex_path in plex_file_paths(section, path):
+            if plex_path in files_index:
+                return files_index[plex_path]
+
+    # fall back to a small title search if Plex renamed or moved the file
+    search_results = section.searchTracks(title=deezer_track['title'])
+    search_index = build_library_index({track.ratingKey: library_track_record(track) for track in search_results})
+    return find_library_track(search_index, deezer_track)
+
+
+def sync_downloaded_tracks(deezer_playlists, deezer_playlist_missing_tracks, downloaded_paths, unmatched_plex_tracks):
+    # add only the newly downloaded tracks to the playlists that were missing them
+    # and remove the unmatched tracks the first sync pass left in place because it had nothing to add
+    section = plex_server.library.section(config['plex_library'])
+    files_index = {record['file']: rating_key for rating_key, record in library_snapshot['tracks'].items()}
+    resolved_rating_keys = {}
+
+    for deezer_playlist in deezer_playlists:
+        playlist_config = get_playlist_config(deezer_playlist['id'])
+
+        rating_keys = []
+        match_results = {}
+        for deezer_track in deezer_playlist_missing_tracks.get(deezer_playlist['id'], []):
+            if deezer_track['id'] not in downloaded_paths:
+                continue
+
+            if deezer_track['id'] not in resolved_rating_keys:
+                resolved_rating_keys[deezer_track['id']] = resolve_downloaded_track(
+                    section, deezer_track, downloaded_paths[deezer_track['id']], files_index)
+            rating_key = resolved_rating_keys[deezer_track['id']]
+            if rating_key:
+                rating_keys.append(rating_key)
+                match_results[deezer_track['id']] = rating_key
+
+        found_plex_tracks = fetch_plex_tracks(rating_keys)
+        removed_counter = 0
+        if found_plex_tracks:
+            plex_playlist = find_plex_playlist(deezer_playlist['title'])
+            unmatched_tracks = unmatched_plex_tracks.get(deezer_playlist['id'])
+            if plex_playlist and unmatched_tracks:
+                plex_playlist.removeItems(unmatched_tracks)
+                removed_counter = len(unmatched_tracks)
+            add_to_plex_playlist(plex_playlist, deezer_playlist, playlist_config, found_plex_tracks)
+            save_match_results(deezer_playlist['id'], match_results, replace=False)
+
+        missing_count = len(deezer_playlist_missing_tracks.get(deezer_playlist['id'], [])) - len(found_plex_tracks)
+        logging.info(f"Synced downloads to '{deezer_playlist['title']}' playlist. Added: {len(found_plex_tracks)}, "
+                     f"removed: {removed_counter}, missing: {missing_count}")
+
+
 def deezer_plex_sync(deezer_playlists):
     global plex_server
 
     # get all tracks + playlists in Plex library
     plex_playlists = plex_server.playlists()
-    all_library_tracks = plex_server.library.section(config['plex_library']).all(libtype='track')
+    library_index = build_library_index(refresh_library_snapshot())
 
     missing_by_playlist = {}
+    # unmatched Plex tracks that weren't removed yet because no tracks were added
+    unmatched_by_playlist = {}
 
     sync_playlist_counter = 1
     for deezer_playlist in deezer_playlists:
-        for looped_config in deezer_playlist_configs:
-            if looped_config['id'] == deezer_playlist['id']:
-                playlist_config = looped_config
-                break
+        playlist_config = get_playlist_config(deezer_playlist['id'])
 
         logging.info(f"Syncing {sync_playlist_counter}/{len(deezer_playlists)} Deezer playlist "
                      f"'{deezer_playlist['title']}' to Plex...")
@@ -134,63 +488,54 @@ def deezer_plex_sync(deezer_playlists):
                 plex_playlist_unmatched_tracks = plex_playlist_tracks.copy()
                 break
 
-        missing_by_playlist[deezer_playlist['id']] = deezer_playlist['tracks']['data']
-        found_plex_tracks = []
-
-        # search track match in Plex library
-        for track in all_library_tracks:
-            matching_tracks = [
-                t for t in missing_by_playlist[deezer_playlist['id']]
-
-                if (t['title'].lower() == track.title.lower() or
-                    t['title'].lower().replace('?', '_').replace('/', '_').replace('[', '(').replace(']', ')')
-                    == track.title.lower()) and
-                   ((track.artist()
-                     and t['artist']['name'].lower() in track.artist().title.replace('’', '\'').lower()) or
-                    t['artist']['name'].lower() in str(track.originalTitle).replace('’', '\'').lower())
-            ]
-
-            # process matching track if found
-            if matching_tracks:
-                # use first match
-                matching_track = matching_tracks[0]
-
-                # remove matching track from missing_tracks
-                missing_by_playlist[deezer_playlist['id']].remove(matching_track)
+        plex_playlist_rating_keys = {t.ratingKey for t in plex_playlist_tracks} if plex_playlist_tracks else set()
+
+        # reuse the matches of previous syncs while the Plex track still exists, search the others in Plex library
+        previous_matches = playlist_match_results.get(deezer_playlist['id'], {})
+        while True:
+            missing_by_playlist[deezer_playlist['id']] = []
+            found_rating_keys = []
+            matched_rating_keys = set()
+            match_results = {}
+
+            for deezer_track in deezer_playlist['tracks']['data']:
+                rating_key = previous_matches.get(deezer_track['id'])
+                if rating_key not in library_snapshot['tracks'] or rating_key in matched_rating_keys:
+                    rating_key = find_library_track(library_index, deezer_track, matched_rating_keys)
+                match_results[deezer_track['id']] = rating_key
+                if not rating_key:
+                    missing_by_playlist[deezer_playlist['id']].append(deezer_track)
+                    continue
+                matched_rating_keys.add(rating_key)
+
+                # add matching track to found tracks if not already in playlist
+                if rating_key not in plex_playlist_rating_keys:
+                    found_rating_keys.append(rating_key)
+
+            found_plex_tracks = fetch_plex_tracks(found_rating_keys)
+            if len(found_plex_tracks) == len(found_rating_keys):
+                break
 
-                # remove matching track from unmatched tracks in Plex playlist
-                if plex_playlist_unmatched_tracks and track in plex_playlist_tracks:
-                    plex_playlist_unmatched_tracks.remove(track)
+            # some matched tracks were deleted from Plex, match the playlist again without them
+            library_index = build_library_index(library_snapshot['tracks'])
 
-                # add matching track to found_plex_tracks if not already in playlist
-                if (not plex_playlist_tracks or
-                        not any(playlist_track.ratingKey == track.ratingKey for playlist_track in plex_playlist_tracks)):
-                    found_plex_tracks.append(track)
+        save_match_results(deezer_playlist['id'], match_results)
 
-            # for matching_track in matching_tracks:
-            # logging.debug(f"Matching track title: {matching_track['title']}")
-            # logging.debug(f"Matching track artist: {matching_track['artist']['name']}/{track.artist().title}")
+        # remove matching tracks from unmatched tracks in Plex playlist
+        if plex_playlist_unmatched_tracks:
+            plex_playlist_unmatched_tracks = [t for t in plex_playlist_unmatched_tracks
+                                              if t.ratingKey not in matched_rating_keys]
 
         removed_counter = 0
 
         # add missing tracks to the end of the playlist
         if len(found_plex_tracks) > 0:
-            if plex_playlist:
-                plex_playlist.addItems(found_plex_tracks)
-                if playlist_config['delete_unmatched_from_playlist'] == 1:
-                    plex_playlist.removeItems(plex_playlist_unmatched_tracks)
-                    removed_counter = len(plex_playlist_unmatched_tracks)
-            else:
-                # if the playlist does not exist, create it
-                plex_playlist = plex_server.createPlaylist(deezer_playlist['title'], items=found_plex_tracks)
-                logging.info(f"Created Plex playlist: {deezer_playlist['title']}")
-
-            # update playlist cover
-            if playlist_config['sync_cover_description'] == 1:
-                plex_playlist.uploadPoster(deezer_playlist['picture_xl'])
-                # update description
-                if deezer_playlist['description']:
-                    plex_playlist.editSummary(deezer_playlist['description'])
+            if plex_playlist and playlist_config['delete_unmatched_from_playlist'] == 1:
+                plex_playlist.removeItems(plex_playlist_unmatched_tracks)
+                removed_counter = len(plex_playlist_unmatched_tracks)
+            add_to_plex_playlist(plex_playlist, deezer_playlist, playlist_config, found_plex_tracks)
+        elif plex_playlist_unmatched_tracks and playlist_config['delete_unmatched_from_playlist'] == 1:
+            unmatched_by_playlist[deezer_playlist['id']] = plex_playlist_unmatched_tracks
 
         # logging
         logging.info(
@@ -203,11 +548,14 @@ def deezer_plex_sync(deezer_playlists):
         if len(missing_by_playlist[deezer_playlist['id']]) < 1:
             missing_by_playlist.pop(deezer_playlist['id'])
 
+    if library_snapshot_unsaved:
+        save_library_snapshot(library_snapshot)
+
     logging.info("Synced Deezer playlists to Plex")
-    return missing_by_playlist
+    return missing_by_playlist, unmatched_by_playlist
 
 
-def download(links, bitrate):
+def download(links, bitrate, url_resolver=None):
     # generate download objects for URLs
     downloadObjects = []
     for link in links:
@@ -221,31 +569,122 @@ def download(links, bitrate):
         # append single object to the downloadObjects list
         downloadObjects.append(downloadObject)
 
-    # download objects
-    for obj in downloadObjects:
-        Downloader(dz, obj, settings).start()
+    return start_downloads(downloadObjects, url_resolver)
+
+
+def start_downloads(download_objects, url_resolver=None):
+    # download objects and return the paths of the written files
+    paths = []
+    for obj in download_objects:
+        Downloader(dz, obj, settings, urlResolver=url_resolver).start()
+        paths.extend(file['path'] for file in obj.files)
+
+    return paths
 
 
 def download_deezer_playlists(deezer_playlist_missing_tracks):
-    download_count = 0
+    # queue missing tracks of all playlists, a track in several playlists is downloaded once at the highest bitrate
+    download_queue = {}
     for playlist_config in deezer_playlist_configs:
         playlist_id = playlist_config['id']
 
         for track in deezer_playlist_missing_tracks.get(playlist_id, []):
             # skip download if track has already been attempted before
-            if downloaded_tracks.__contains__(track['id']):
+            if not should_download(track['id']):
                 continue
-            downloaded_tracks.append(track['id'])
 
-            logging.info(f"Download {track['title']} by {track['artist']['name']}...")
+            bitrate = playlist_config['bitrate']
+            if track['id'] in download_queue:
+                bitrate = max(bitrate, download_queue[track['id']][1])
+            download_queue[track['id']] = (track, bitrate)
+
+    logging.info(f"Download {len(download_queue)} missing tracks...")
+
+    track_ids_by_bitrate = {}
+    for track_id, (track, bitrate) in download_queue.items():
+        track_ids_by_bitrate.setdefault(bitrate, []).append(track_id)
+
+    # get the data of all queued tracks of a bitrate at once and resolve their media URLs in batches
+    download_objects = {}
+    url_resolvers = {}
+    for bitrate, track_ids in track_ids_by_bitrate.items():
+        track_items = generateTrackItems(dz, track_ids, bitrate)
+        download_objects.update(track_items)
+        # the generated tracks keep their track token, the resolver only fetches the tokens of the others
+        track_tokens = {link_id: (item.single['trackAPI']['track_token'], item.single['trackAPI']['track_token_expire'])
+                        for link_id, item in track_items.items()}
+        url_resolvers[bitrate] = TrackURLResolver(dz, track_ids, bitrate, trackTokens=track_tokens)
+
+    # download tracks concurrently, tracks that couldn't be fetched at once are generated from their link
+    futures = {}
+    with ThreadPoolExecutor(settings['queueConcurrency']) as executor:
+        for track_id, (track, bitrate) in download_queue.items():
+            if str(track_id) in download_objects:
+                futures[track_id] = executor.submit(start_downloads, [download_objects[str(track_id)]],
+                                                    url_resolvers[bitrate])
+            else:
+                futures[track_id] = executor.submit(download, [track['link']], bitrate, url_resolvers[bitrate])
 
-            # download track
-            download([track['link']], playlist_config['bitrate'])
-            download_count = download_count + 1
+    downloaded_paths = {}
+    download_count = 0
+    for track_id, future in futures.items():
+        track = download_queue[track_id][0]
+        try:
+            paths = future.result()
+        except Exception as e:
+            logging.error(f"Error while downloading {track['title']} by {track['artist']['name']}: {e}")
+            paths = []
 
+        if paths:
+            downloaded_paths[track_id] = paths
+            save_download_outcome(track_id, 'downloaded')
+            download_count = download_count + 1
             logging.info(f"Downloaded {track['title']} by {track['artist']['name']}")
+        else:
+            save_download_outcome(track_id, 'failed')
+            logging.info(f"Failed to download {track['title']} by {track['artist']['name']}")
 
     logging.info(f"Downloaded {download_count} new tracks")
+    logging.debug(f"Album metadata cache: {albumCache.getStats()}, artist metadata cache: {artistCache.getStats()}")
+    logging.debug(f"Artwork cache: {artworkCache.getStats()}")
+    logging.debug(f"HTTP connection pools: {sessionPool.getStats()}")
+    return downloaded_paths
+
+
+def plex_file_paths(section, path):
+    # map a path below the music folder to the paths Plex may see it at
+    relative_path = os.path.relpath(path, music_path)
+    return [os.path.join(location, relative_path) for location in section.locations]
+
+
+def wait_for_plex_indexing(paths):
+    section = plex_server.library.section(config['plex_library'])
+    pending_paths = {path: set(plex_file_paths(section, path)) for path in paths}
+
+    # scan only the folders that were written to
+    folders = {plex_path for path in paths for plex_path in plex_file_paths(section, os.path.dirname(path))}
+    for folder in folders:
+        section.update(path=folder)
+    logging.info(f"Requested Plex scan of {len(folders)} folders, waiting for {len(paths)} new files...")
+
+    timeout_seconds = config.get('plex_index_timeout_seconds', 300)
+    started = time.monotonic()
+    while pending_paths:
+        # only poll the changes, the snapshot is saved once the wait is over
+        indexed_files = {record['file'] for record in refresh_library_snapshot(check_size=False, save=False).values()}
+        pending_paths = {path: plex_paths for path, plex_paths in pending_paths.items()
+                         if not plex_paths & indexed_files}
+        if not pending_paths:
+            break
+
+        if time.monotonic() - started > timeout_seconds:
+            logging.info(f"Plex didn't index {len(pending_paths)} new files within {timeout_seconds} seconds")
+            break
+        time.sleep(5)
+
+    if library_snapshot_unsaved:
+        save_library_snapshot(library_snapshot)
+    logging.info(f"Plex indexed {len(paths) - len(pending_paths)}/{len(paths)} new files")
 
 
 def file_contains_string(folder_path, search_string):
@@ -280,36 +719,59 @@ def loop():
             intervalSeconds = 20
             logging.info(f"No changes detected, sleeping for {intervalSeconds} seconds...")
             time.sleep(intervalSeconds)
-            pass
+            continue
 
         # sync playlists to Plex and find missing tracks
-        deezer_playlist_missing_tracks = deezer_plex_sync(changed_deezer_playlists)
+        deezer_playlist_missing_tracks, unmatched_plex_tracks = deezer_plex_sync(changed_deezer_playlists)
 
         if deezer_playlist_missing_tracks:
             # download missing tracks
             logging.info(f"Downloading missing tracks")
-            download_deezer_playlists(deezer_playlist_missing_tracks)
+            downloaded_paths = download_deezer_playlists(deezer_playlist_missing_tracks)
+
+            if downloaded_paths:
+                # wait until Plex indexed the new files
+                wait_for_plex_indexing([path for paths in downloaded_paths.values() for path in paths])
 
-            # give Plex time to index new files
-            seconds = 60
-            logging.info(f"Wait {seconds} seconds until syncing playlist with new downloads")
-            time.sleep(seconds)
+                # add the new files to the playlists
+                sync_downloaded_tracks(changed_deezer_playlists, deezer_playlist_missing_tracks, downloaded_paths,
+                                       unmatched_plex_tracks)
 
-            # resync playlists with new files
-            deezer_plex_sync(changed_deezer_playlists)
+        # only persist checksums of synced playlists, so an interrupted sync is redone after a restart
+        save_playlist_state([playlist['id'] for playlist in changed_deezer_playlists])
 
         logging.info(f"Finished sync cycle {cycleCount}")
         cycleCount = cycleCount + 1
 
 
+def fetch_deezer_playlist(playlist_id):
+    deezer_api_rate_limiter.wait()
+    return dz.api.get_playlist(playlist_id)
+
+
+def fetch_deezer_playlist_checksum(playlist_id):
+    # playlist metadata only, gw.get_playlist would return the playlist page including its tracks
+    deezer_api_rate_limiter.wait()
+    playlist_data = dz.gw.api_call('playlist.getData', {'PLAYLIST_ID': playlist_id})
+    if playlist_data.get('CHECKSUM'):
+        return playlist_data['CHECKSUM']
+    return f"{playlist_data['DATE_MOD']}-{playlist_data['NB_SONG']}"
+
+
+def fetch_playlists_concurrently(function, playlist_configs):
+    # a failing playlist doesn't affect the others, errors are raised by the returned futures
+    with ThreadPoolExecutor(config.get('playlist_poll_workers', 8)) as executor:
+        futures = [executor.submit(function, playlist_config['id']) for playlist_config in playlist_configs]
+    return list(zip(playlist_configs, futures))
+
+
 def update_playlists():
     global cached_deezer_playlists
     global playlist_last_sync_time
 
     logging.info("Update playlist info from Deezer...")
 
-    playlists = []
-    update_count = 0
+    due_playlist_configs = []
     for playlist_config in deezer_playlist_configs:
         # skip if set inactive by user
         if playlist_config['active'] == 0:
@@ -321,17 +783,38 @@ def update_playlists():
             if seconds_between < playlist_config['sync_interval_seconds']:
                 continue
 
-        # fetch playlist
+        due_playlist_configs.append(playlist_config)
+
+    # detect changes to playlists using checksum
+    checksums = {}
+    changed_playlist_configs = []
+    update_count = 0
+    for playlist_config, future in fetch_playlists_concurrently(fetch_deezer_playlist_checksum,
+                                                                due_playlist_configs):
         try:
-            playlist = dz.api.get_playlist(playlist_config['id'])
+            checksum = future.result()
+        except Exception as e:
+            logging.info(f"Failed to fetch playlist {playlist_config['id']}: {e}")
+            continue
 
-            # detect changes to playlist using checksum
-            if (not cached_deezer_playlists.__contains__(playlist_config['id']) or
-                    cached_deezer_playlists[playlist_config['id']] != playlist['checksum']):
+        if (not cached_deezer_playlists.__contains__(playlist_config['id']) or
+                cached_deezer_playlists[playlist_config['id']] != checksum):
+            checksums[playlist_config['id']] = checksum
+            changed_playlist_configs.append(playlist_config)
+        else:
+            playlist_last_sync_time[playlist_config['id']] = time.time()
+            save_playlist_state([playlist_config['id']])
+            update_count += 1
+
+    # fetch full playlists with tracks only for changed playlists
+    playlists = []
+    for playlist_config, future in fetch_playlists_concurrently(fetch_deezer_playlist, changed_playlist_configs):
+        try:
+            playlist = future.result()
 
-                # save changes and add to changed playlist queue
-                playlists.append(playlist)
-                cached_deezer_playlists[playlist_config['id']] = playlist['checksum']
+            # save changes and add to changed playlist queue
+            playlists.append(playlist)
+            cached_deezer_playlists[playlist_config['id']] = checksums[playlist_config['id']]
 
             playlist_last_sync_time[playlist_config['id']] = time.time()
             update_count += 1
@@ -356,4 +839,5 @@ if len(deezer_playlist_configs) < 1:
     logging.info("No sync playlist configured, quitting...")
     quit()
 
+load_sync_state()
 loop()